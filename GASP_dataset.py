@@ -8,8 +8,15 @@ import torch
 from torch_geometric.data import Data, Dataset
 from torch_geometric.utils import from_scipy_sparse_matrix, k_hop_subgraph
 
+from utils import distance_sigmoid
+
+# Graph attributes stored in the packed dataset, concatenated over nodes or edges respectively
+PACKED_NODE_KEYS = ('x', 'y', 'coords', 'closest_ligand', 'atom_index', 'surf_mask')
+PACKED_EDGE_KEYS = ('edge_index', 'edge_attr')
+
 class GASPData(Dataset):
-    def __init__(self, root:str, num_cpus:int, cutoff:int=5, surface_subgraph_hops:int=None, sasa_threshold:float=1e-4):
+    def __init__(self, root:str, num_cpus:int, cutoff:int=5, surface_subgraph_hops:int=None, sasa_threshold:float=1e-4,
+                 label_params:tuple=None, packed:bool=False):
         """A PyG dataset for protein graphs
 
         Parameters
@@ -25,24 +32,47 @@ class GASPData(Dataset):
             When set to none, the full graph is used, by default None
         sasa_threshold : float, optional
             The minumum ammount of solvent accessible surface area to be considered a surface atom, by default 1e-4
+        label_params : tuple, optional
+            Sigmoid parameters (label_midpoint, label_slope). When set, data.y is returned as [N, 2] float16 soft labels
+            instead of ligand distances, by default None
+        packed : bool, optional
+            If True, graphs are read as views into one memory-mapped file per attribute (see pack) instead of 
+            one torch.load per graph. The packed copy is built on first use and rebuilt when the processed 
+            files change, by default False
         """        
         self.cutoff = cutoff
         self.num_cpus = num_cpus
         self.hops = surface_subgraph_hops
         self.sasa_thresold = sasa_threshold
+        self.label_params = label_params
+        self.packed = packed
+        self._packed_arrays = None
+        self._raw_names = None
         
         if not os.path.isdir(root + '/processed'):
             os.mkdir(root + '/processed')
         
         super().__init__(root, None, None)
 
+        if self.packed and self.packed_is_stale():
+            self.pack()
+
+    def __getstate__(self):
+        """Drops the memory maps when the dataset is copied or sent to another process, each process reopens them on first access."""
+        state = self.__dict__.copy()
+        state['_packed_arrays'] = None
+        return state
+
     @property
     def raw_file_names(self):
         """:obj:`list` of :obj:`str`: List of file names in the raw directory. 
         
         The list is returned in sorted order, the same order that the directory is processed in.
+        The directory is listed once and cached, since the length, indexing, and split masks all depend on it.
         """
-        return sorted(os.listdir(self.raw_dir))
+        if self._raw_names is None:
+            self._raw_names = sorted(os.listdir(self.raw_dir))
+        return self._raw_names
     
     @property
     def processed_file_names(self):
@@ -52,6 +82,11 @@ class GASPData(Dataset):
         """
         return sorted(os.listdir(self.processed_dir))
     
+    @property
+    def packed_dir(self):
+        """str: Path to the directory holding the packed copy of the processed dataset."""
+        return os.path.join(self.root, 'packed')
+
     def len(self):
         """int: Returns the number of raw files associated with the dataset."""        
         return len(self.raw_file_names)
@@ -145,6 +180,118 @@ class GASPData(Dataset):
         Parallel(n_jobs=self.num_cpus)(delayed(self.process_helper)(self.processed_dir, raw_path, i, cutoff=self.cutoff) for i, raw_path in enumerate(sorted(self.raw_paths)))
         print("Finished Dataset Processing")
 
+    def load_processed(self, idx:int):
+        """Loads a single processed graph from its data_idx.pt file.
+
+        Parameters
+        ----------
+        idx : int
+            Index of the data point to be loaded
+
+        Returns
+        -------
+        pytorch_geometric.data.Data
+            The processed graph as saved by process_helper.
+        """
+        try:
+            return torch.load(os.path.join(self.processed_dir, 'data_{}.pt'.format(idx)))
+        # If the processed datapoint fails to load, attempt to process it again from raw. If it fails again this will raise and Exception
+        except Exception as e:
+            print("Failed Loading File {}/data_{}.pt".format(self.processed_dir,idx), flush=True)
+            print(self.cutoff)
+            self.process_helper(self.processed_dir, self.raw_paths[idx], idx, cutoff=self.cutoff)
+            return torch.load(os.path.join(self.processed_dir, 'data_{}.pt'.format(idx)))
+
+    def packed_is_stale(self):
+        """bool: True if the packed dataset is missing, has a different number of graphs, or is older than a processed file."""
+        ptr_path = os.path.join(self.packed_dir, 'node_ptr.npy')
+        if not os.path.exists(ptr_path):
+            return True
+        if len(np.load(ptr_path)) - 1 != self.len():
+            return True
+        packed_time = os.path.getmtime(ptr_path)
+        return any(entry.stat().st_mtime > packed_time for entry in os.scandir(self.processed_dir))
+
+    def pack(self):
+        """Packs all processed graphs into one .npy file per attribute in root/packed, with node and edge 
+        offset tables, so that get can return zero-copy views of a memory map instead of unpickling a file per graph.
+        Edge indices are stored per graph (not offset) as [num_edges, 2].
+        """
+        print("Packing processed dataset into {}".format(self.packed_dir), flush=True)
+        num_graphs = self.len()
+        node_ptr = np.zeros(num_graphs + 1, dtype=np.int64)
+        edge_ptr = np.zeros(num_graphs + 1, dtype=np.int64)
+
+        # First pass: sizes of every graph and the dtype and trailing shape of every attribute
+        specs = {}
+        for i in range(num_graphs):
+            data = self.load_processed(i)
+            node_ptr[i+1] = data.num_nodes
+            edge_ptr[i+1] = data.num_edges
+            if i == 0:
+                for key in PACKED_NODE_KEYS + PACKED_EDGE_KEYS:
+                    if key in data:
+                        value = data[key].numpy()
+                        specs[key] = (value.dtype, value.shape[::-1][1:] if key == 'edge_index' else value.shape[1:])
+        node_ptr = np.cumsum(node_ptr)
+        edge_ptr = np.cumsum(edge_ptr)
+
+        # Second pass: copy each graph into its slice of the packed arrays
+        if not os.path.isdir(self.packed_dir):
+            os.makedirs(self.packed_dir)
+        arrays = {}
+        for key, (dtype, shape) in specs.items():
+            total = node_ptr[-1] if key in PACKED_NODE_KEYS else edge_ptr[-1]
+            arrays[key] = np.lib.format.open_memmap(os.path.join(self.packed_dir, key + '.npy'), mode='w+', dtype=dtype, shape=(total,) + shape)
+        for i in range(num_graphs):
+            data = self.load_processed(i)
+            for key, array in arrays.items():
+                ptr = node_ptr if key in PACKED_NODE_KEYS else edge_ptr
+                value = data[key].numpy()
+                array[ptr[i]:ptr[i+1]] = value.T if key == 'edge_index' else value
+        for array in arrays.values():
+            array.flush()
+        del arrays
+
+        # Offsets are written last so that an interrupted pack is detected as stale
+        np.save(os.path.join(self.packed_dir, 'edge_ptr.npy'), edge_ptr)
+        np.save(os.path.join(self.packed_dir, 'node_ptr.npy'), node_ptr)
+        print("Finished Dataset Packing")
+
+    def get_packed(self, idx:int):
+        """Returns a graph built from views into the packed, memory-mapped dataset.
+
+        The memory maps are opened copy-on-write on first access in each process, so the 
+        views are writable but changes are never written back to disk.
+
+        Parameters
+        ----------
+        idx : int
+            Index of the data point to be retrieved 
+
+        Returns
+        -------
+        pytorch_geometric.data.Data
+            A data pytorch geometric data object representing the featurized protein graph.
+        """
+        if self._packed_arrays is None:
+            self._packed_arrays = {os.path.splitext(file_name)[0]: np.load(os.path.join(self.packed_dir, file_name), mmap_mode='c') 
+                                   for file_name in os.listdir(self.packed_dir)}
+        arrays = self._packed_arrays
+        node_slice = slice(arrays['node_ptr'][idx], arrays['node_ptr'][idx+1])
+        edge_slice = slice(arrays['edge_ptr'][idx], arrays['edge_ptr'][idx+1])
+
+        data = Data()
+        for key in PACKED_NODE_KEYS:
+            if key in arrays:
+                data[key] = torch.from_numpy(arrays[key][node_slice])
+        for key in PACKED_EDGE_KEYS:
+            if key in arrays:
+                data[key] = torch.from_numpy(arrays[key][edge_slice])
+        data.edge_index = data.edge_index.t()
+
+        return data
+
     def get(self,idx:int):
         """Returns a data object that represents the protein graph. See the following link 
         for more details on the object: 
@@ -159,12 +306,14 @@ class GASPData(Dataset):
         -------
         pytorch_geometric.data.Data
             A data pytorch geometric data object representing the featurized protein graph.
+            If label_params is set, data.y holds [1-p, p] soft labels computed from the ligand distances.
         """        
-        try:
-            return torch.load(os.path.join(self.processed_dir, 'data_{}.pt'.format(idx))), self.raw_file_names[idx]
-        # If the processed datapoint fails to load, attempt to process it again from raw. If it fails again this will raise and Exception
-        except Exception as e:
-            print("Failed Loading File {}/data_{}.pt".format(self.processed_dir,idx), flush=True)
-            print(self.cutoff)
-            self.process_helper(self.processed_dir, self.raw_paths[idx], idx, cutoff=self.cutoff)
-            return torch.load(os.path.join(self.processed_dir, 'data_{}.pt'.format(idx))), self.raw_file_names[idx]
+        data = self.get_packed(idx) if self.packed else self.load_processed(idx)
+
+        # Compute soft labels with sigmoid of distance in the loader workers
+        if self.label_params is not None:
+            label_midpoint, label_slope = self.label_params
+            y = distance_sigmoid(data.y, label_midpoint, label_slope)
+            data.y = torch.stack([1-y, y], dim=1).half()
+
+        return data, self.raw_file_names[idx]
@@ -9,12 +9,11 @@ from torch_geometric.loader import DataLoader
 from torch_geometric.nn import GATConv, GATv2Conv
 
 from sklearn.metrics import accuracy_score, roc_curve, auc, average_precision_score
-from sklearn.metrics import matthews_corrcoef as mcc
 import torch
 
 from GASP_dataset import GASPData
 from model import GAT_model
-from utils import distance_sigmoid, initialize_model
+from utils import binary_mcc, distance_sigmoid, initialize_model
 
 def k_fold(dataset:GASPData, prepend:str, fold_number:int):
     """Returns a boolean mask over the dataset that seperates it into training and validation portions
@@ -38,23 +37,13 @@ def k_fold(dataset:GASPData, prepend:str, fold_number:int):
         A tuple of (training_mask, validation_mask) which can be used as boolean masks over the dataset.
     """    
     val_names    = np.loadtxt(prepend + "/splits/test_ids_fold"  + str(fold_number), dtype='str')
-    train_names   = np.loadtxt(prepend + "/splits/train_ids_fold" + str(fold_number), dtype='str')
     
-    train_indices, val_indices = [], []
-    
-    # Iterate over the raw dataset file names and check if they're in the training or validation file.
-    for idx, name in enumerate(dataset.raw_file_names):
-        if name[:4] in val_names: 
-            val_indices.append(idx)
-        if name[:4] in train_names:
-            train_indices.append(idx)
-
-    train_mask = torch.ones(len(dataset), dtype=torch.bool)
-    val_mask = torch.ones(len(dataset), dtype=torch.bool)
-    
-    # Remove all val_indices from the training set and vice-versa
-    train_mask[val_indices] = 0
-    val_mask[train_mask] = 0
+    # Check which raw dataset file names are in the validation file.
+    prefixes = np.array([name[:4] for name in dataset.raw_file_names])
+    val_mask = torch.from_numpy(np.isin(prefixes, val_names))
+
+    # Everything outside the validation set is used for training
+    train_mask = ~val_mask
 
     return train_mask, val_mask
 
@@ -243,35 +232,33 @@ def infer_test(args):
                 labels = labels[surf_mask]
                 out = out[surf_mask]
 
-            probs = F.softmax(out, dim=-1) 
-            all_probs = torch.cat((all_probs, probs.detach().cpu()))
-            all_labels = torch.cat((all_labels, labels.detach().cpu()))
+            preds = out.argmax(dim=-1).cpu().numpy()   # argmax(softmax(x)) == argmax(x), so only the [N] predictions leave the gpu
+            probs = F.softmax(out, dim=-1).cpu()        # Single host copy of the probabilities, reused for metrics and saving
             loss_fn = torch.nn.CrossEntropyLoss()
             loss = loss_fn(out, labels)        # Cross Entropy
-            preds = np.argmax(probs.detach().cpu().numpy(), axis=1) # [1 if x[1] > prediction_threshold else 0 for x in probs]
-            bl = loss.detach().cpu().item()
+            bl = loss.item()
             
-            # Mask out all atoms if not on surface and surface_only for metrics
-            labels = batch.y.detach().cpu()
-            if surface_only:
-                labels = labels[surf_mask.detach().cpu()]
+            # Labels are already masked to the surface if surface_only, copy them to the host once for metrics and saving
+            labels = labels.cpu()
+            all_probs = torch.cat((all_probs, probs))
+            all_labels = torch.cat((all_labels, labels))
 
             hard_labels = np.argmax(labels, axis=1)
-            surf_masks = batch.surf_mask.detach().cpu()
-            atom_indices = batch.atom_index.detach().cpu()
+            surf_masks = batch.surf_mask.cpu()
+            atom_indices = batch.atom_index.cpu()
             
             ba = accuracy_score(hard_labels, preds)
-            bm = mcc(hard_labels, preds)
-            bpr = average_precision_score(hard_labels, probs.detach().cpu().numpy()[:,1])
+            bm = binary_mcc(torch.as_tensor(hard_labels), torch.as_tensor(preds)).item()
+            bpr = average_precision_score(hard_labels, probs[:,1].numpy())
 
             datapoint_loss += bl
             datapoint_accuracy  += ba
             datapoint_mcc  += bm
             datapoint_pr_auc += bpr
-            np.save(prob_path + assembly_name, probs.detach().cpu().numpy())
-            np.save(label_path + assembly_name, labels.detach().cpu().numpy())
-            np.save(surface_path + assembly_name, surf_masks.detach().cpu().numpy())
-            np.save(index_path + assembly_name, atom_indices.detach().cpu().numpy())
+            np.save(prob_path + assembly_name, probs.numpy())
+            np.save(label_path + assembly_name, labels.numpy())
+            np.save(surface_path + assembly_name, surf_masks.numpy())
+            np.save(index_path + assembly_name, atom_indices.numpy())
 
         test_epoch_loss.append(datapoint_loss/len(val_dataloader))
         test_epoch_acc.append(datapoint_accuracy/len(val_dataloader))
@@ -282,8 +269,8 @@ def infer_test(args):
         print("MCC:  {}".format(test_epoch_mcc[-1]))
         print("PR AUC: {}".format(test_epoch_pr_auc[-1]))
 
-    all_probs  =  all_probs.detach().cpu().numpy()
-    all_labels = all_labels.detach().cpu().numpy()
+    all_probs  =  all_probs.numpy()
+    all_labels = all_labels.numpy()
 
     np.savez(all_prob_path + 'all_probs', all_probs)
     np.savez(all_label_path + 'all_labels', all_labels)
@@ -414,16 +401,16 @@ def infer_production(args):
 
             probs = F.softmax(out, dim=-1) 
 
-            surf_masks = batch.surf_mask.detach().cpu()
-            atom_indices = batch.atom_index.detach().cpu()
+            surf_masks = batch.surf_mask.cpu()
+            atom_indices = batch.atom_index.cpu()
 
             # Save probabilities, surface mask, and indices for each complex
-            np.save(prob_path + assembly_name, probs.detach().cpu().numpy())
-            np.save(surface_path + assembly_name, surf_masks.detach().cpu().numpy())
-            np.save(index_path + assembly_name, atom_indices.detach().cpu().numpy())
+            np.save(prob_path + assembly_name, probs.cpu().numpy())
+            np.save(surface_path + assembly_name, surf_masks.numpy())
+            np.save(index_path + assembly_name, atom_indices.numpy())
 
     # Save probabilities for all complexes
-    all_probs = all_probs.detach().cpu().numpy()
+    all_probs = all_probs.numpy()
 
     np.savez(all_prob_path + 'all_probs', all_probs)
 
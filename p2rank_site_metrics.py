@@ -5,6 +5,7 @@ from MDA_fix.MOL2Parser import MOL2Parser # fix added in MDA development build
 import os
 from tqdm import tqdm
 from glob import glob
+from scipy.spatial.distance import cdist
 
 import time
 
@@ -13,29 +14,6 @@ import argparse
 from joblib import Parallel, delayed
 
 
-def DCA_dist(center, lig_coords):
-    """Compute the distance to the nearest ligand heavy atom for a binding site center.
-
-    Parameters
-    ----------
-    center: numpy.ndarray
-        Binding site center.
-    
-    lig_coords: numpy.ndarray
-        Heavy atom coordinates for all ligands.
-
-    Returns
-    -------
-    numpy.ndarray
-        Minimum distance from site center to ligand heavy atoms.
-    """
-
-    distances = np.sqrt(np.sum((center - lig_coords)**2, axis=1))
-    shortest = np.min(distances)
-    
-    return shortest
-
-
 def get_p2rank_centers(prediction_dir, system):
     """Load P2Rank site centers.
 
@@ -97,15 +75,10 @@ def multisite_metrics(lig_coord_list, predicted_center_list, top_n_plus=0, known
     
 
     if len(predicted_center_list) > 0:          
-        DCA_matrix = np.zeros([len(lig_coord_list), len(predicted_center_list)])
-
-        for index, x in np.ndenumerate(DCA_matrix):
-            true_ind, pred_ind = index
-
-            predicted_center = predicted_center_list[pred_ind]
-            lig_coords = lig_coord_list[true_ind]
+        predicted_centers = np.asarray(predicted_center_list)
 
-            DCA_matrix[index] = DCA_dist(predicted_center, lig_coords)
+        # Rows are ligands, columns are predicted sites
+        DCA_matrix = np.array([np.min(cdist(predicted_centers, lig_coords), axis=1) for lig_coords in lig_coord_list])
 
         DCA = np.min(DCA_matrix, axis=1)
 
@@ -299,28 +272,30 @@ if __name__ == "__main__":
             n_predicted=n_predicted, names=names)
 
         n_predicted = np.array(n_predicted)
+        avg_n_predicted = np.nanmean(n_predicted)
+        no_prediction_total = np.sum(no_prediction_count)
 
         print("-----------------------------------------------------------------------------------", flush=True)
         print(f"top n + {top_n_plus} prediction")
         print("-----------------------------------------------------------------------------------", flush=True)
-        print(f"Number of systems with no predictions: {np.sum(no_prediction_count)}", flush=True)
+        print(f"Number of systems with no predictions: {no_prediction_total}", flush=True)
 
         out.write("-----------------------------------------------------------------------------------\n")
         out.write(f"top n + {top_n_plus} prediction\n")
         out.write("-----------------------------------------------------------------------------------\n")
-        out.write(f"Number of systems with no predictions: {np.sum(no_prediction_count)}\n")
+        out.write(f"Number of systems with no predictions: {no_prediction_total}\n")
 
         DCA_recall, DCA_precision = criteria_to_metrics(DCA, top_predicted)
         print(f"DCA Recall: {DCA_recall}", flush=True)
         print(f"DCA Precision: {DCA_precision}", flush=True)
 
-        print(f"Average n_predicted: {np.nanmean(n_predicted)}", flush=True)
+        print(f"Average n_predicted: {avg_n_predicted}", flush=True)
 
 
         out.write(f"DCA Recall: {DCA_recall}\n")
         out.write(f"DCA Precision: {DCA_precision}\n")
 
-        out.write(f"Average n_predicted: {np.nanmean(n_predicted)}\n")
+        out.write(f"Average n_predicted: {avg_n_predicted}\n")
         #######################################################################################
 
     for top in top_list:
@@ -343,27 +318,29 @@ if __name__ == "__main__":
             n_predicted=n_predicted, names=names)
 
         n_predicted = np.array(n_predicted)
+        avg_n_predicted = np.nanmean(n_predicted)
+        no_prediction_total = np.sum(no_prediction_count)
 
         print("-----------------------------------------------------------------------------------", flush=True)
         print(f"top {top} prediction")
         print("-----------------------------------------------------------------------------------", flush=True)
-        print(f"Number of systems with no predictions: {np.sum(no_prediction_count)}", flush=True)
+        print(f"Number of systems with no predictions: {no_prediction_total}", flush=True)
 
         out.write("-----------------------------------------------------------------------------------\n")
         out.write(f"top {top} prediction\n")
         out.write("-----------------------------------------------------------------------------------\n")
-        out.write(f"Number of systems with no predictions: {np.sum(no_prediction_count)}\n")
+        out.write(f"Number of systems with no predictions: {no_prediction_total}\n")
 
         DCA_recall, DCA_precision = criteria_to_metrics(DCA, top_predicted)
         print(f"DCA Recall: {DCA_recall}", flush=True)
         print(f"DCA Precision: {DCA_precision}", flush=True)
 
-        print(f"Average n_predicted: {np.nanmean(n_predicted)}", flush=True)
+        print(f"Average n_predicted: {avg_n_predicted}", flush=True)
 
 
         out.write(f"DCA Recall: {DCA_recall}\n")
         out.write(f"DCA Precision: {DCA_precision}\n")
 
-        out.write(f"Average n_predicted: {np.nanmean(n_predicted)}\n")
+        out.write(f"Average n_predicted: {avg_n_predicted}\n")
         #######################################################################################
     out.close()
@@ -6,9 +6,13 @@ from sklearn.neighbors import radius_neighbors_graph
 from sklearn.cluster import MeanShift, estimate_bandwidth, DBSCAN, AgglomerativeClustering
 import networkx as nx 
 from networkx.algorithms.community import louvain_communities
-from scipy.spatial import ConvexHull, Delaunay
-from scipy.optimize import linprog
+from scipy.spatial import ConvexHull, Delaunay, QhullError, cKDTree
+from scipy.spatial.distance import cdist
+from scipy.sparse.csgraph import connected_components
 import os
+import shutil
+import signal
+import tempfile
 from tqdm import tqdm
 from glob import glob
 
@@ -17,7 +21,8 @@ import time
 
 import sys
 import argparse
-from joblib import Parallel, delayed
+from joblib import Parallel, delayed, dump, load
+from concurrent.futures import ThreadPoolExecutor
 import warnings
 
 
@@ -37,7 +42,27 @@ def center_of_mass(coords, masses):
         Center of mass.
     """
 
-    return np.sum(coords*np.tile(masses, (3,1)).T, axis=0)/np.sum(masses)
+    return np.einsum('i,ij->j', np.asarray(masses), np.asarray(coords))/np.sum(masses)
+
+def site_probabilities(probs):
+    """Extract the site class probability for each atom as a contiguous array.
+
+    Parameters
+    ----------
+    probs : numpy.ndarray
+        Class probabilities with site in column 1, or site probabilities alone.
+
+    Returns
+    -------
+    numpy.ndarray
+        Site probability for each atom.
+    """
+
+    probs = np.asarray(probs)
+    if probs.ndim == 2:
+        probs = probs[:,1]
+
+    return np.ascontiguousarray(probs)
 
 def sort_clusters(cluster_ids, probs, labels, score_type='mean'):
     """Sort clusters according to binding site scores.
@@ -62,30 +87,33 @@ def sort_clusters(cluster_ids, probs, labels, score_type='mean'):
         Resorted clusters labels with highest scoring first.
     """
 
-    c_probs = []
-    unique_ids = np.unique(cluster_ids)
+    if score_type not in ['mean', 'sum', 'square']:
+        raise ValueError(f"sort_clusters score_type must be mean, sum, or square, got {score_type!r}.")
 
-    for c_id in unique_ids[unique_ids >= 0]:
-        if score_type == 'mean':
-            c_prob = np.mean(probs[:,1][labels][cluster_ids==c_id])
-        elif score_type == 'sum':
-            c_prob = np.sum(probs[:,1][labels][cluster_ids==c_id])
-        elif score_type == 'square':
-            c_prob = np.sum((probs[:,1][labels][cluster_ids==c_id])**2)
-        else:
-            print('sort_clusters score_type must be mean, sum, or square.')
-        c_probs.append(c_prob)
+    site_probs = site_probabilities(probs)[labels]
+    if score_type == 'square':
+        site_probs = site_probs**2
 
-    c_order = np.argsort(c_probs)
+    # Aggregate atom scores for every cluster in a single pass
+    valid = cluster_ids >= 0
+    valid_ids = cluster_ids[valid].astype(int)
+    c_counts = np.bincount(valid_ids)
+    c_probs = np.bincount(valid_ids, weights=site_probs[valid], minlength=len(c_counts))
+    present = np.flatnonzero(c_counts)
+    if score_type == 'mean':
+        c_probs[present] = c_probs[present] / c_counts[present]
+
+    # Old cluster ids ordered by score, then invert the permutation to relabel every atom at once
+    c_order = present[np.argsort(c_probs[present])]
+    rank = np.full(len(c_counts), -1, dtype=np.int32)
+    rank[c_order] = np.arange(len(c_order))
+
+    sorted_ids = np.full(cluster_ids.shape, -1, dtype=np.int32)
+    sorted_ids[valid] = rank[valid_ids]
 
-    sorted_ids = -1*np.ones(cluster_ids.shape)
-    for new_c in range(len(c_order)):
-        old_c = c_order[new_c]
-        sorted_ids[cluster_ids == old_c] = new_c
-        
     return sorted_ids
 
-def cluster_atoms_meanshift(all_coords, predicted_probs, threshold=.5, quantile=.3, bw=None, score_type='mean', **kwargs):
+def cluster_atoms_meanshift(all_coords, predicted_probs, threshold=.5, quantile=.3, bw=None, bw_samples=500, score_type='mean', **kwargs):
     """Cluster atoms into sites with meanshift clustering.
 
     Parameters
@@ -105,6 +133,9 @@ def cluster_atoms_meanshift(all_coords, predicted_probs, threshold=.5, quantile=
     bw: float
         Static meanshift bandwidth (as opposed to quantile-based).
 
+    bw_samples: int
+        Maximum number of site atoms sampled to estimate the bandwidth (fixed seed).
+
     score_type: str
         Option for atom score aggregation.
 
@@ -123,14 +154,15 @@ def cluster_atoms_meanshift(all_coords, predicted_probs, threshold=.5, quantile=
         Sorted cluster ids for all atoms with -1 representing non-site.
     """
 
-    predicted_labels = predicted_probs[:,1] > threshold
+    site_probs = site_probabilities(predicted_probs)
+    predicted_labels = site_probs > threshold
     if np.sum(predicted_labels) == 0:
         # No positive predictions were made with specified cutoff
         return None, None, None
     bind_coords = all_coords[predicted_labels]
     if bind_coords.shape[0] != 1:
         if bw is None:
-            bw = estimate_bandwidth(bind_coords, quantile=quantile)
+            bw = estimate_bandwidth(bind_coords, quantile=quantile, n_samples=min(bw_samples, len(bind_coords)), random_state=0)
         if bw == 0:
             bw = 1e-17
         try:
@@ -139,13 +171,13 @@ def cluster_atoms_meanshift(all_coords, predicted_probs, threshold=.5, quantile=
             raise e
         cluster_ids = ms_clustering.labels_
         
-        sorted_ids = sort_clusters(cluster_ids, predicted_probs, predicted_labels, score_type=score_type)
+        sorted_ids = sort_clusters(cluster_ids, site_probs, predicted_labels, score_type=score_type)
     else:
         # Under rare circumstances only one atom may be predicted as the binding pocket. In this case
         # the clustering fails so we'll just call this one atom our best 'cluster'.
-        sorted_ids = [0]
+        sorted_ids = np.zeros(1, dtype=np.int32)
 
-    all_ids = -1*np.ones(predicted_labels.shape)
+    all_ids = np.full(predicted_labels.shape, -1, dtype=np.int32)
     all_ids[predicted_labels] = sorted_ids
 
     return bind_coords, sorted_ids, all_ids
@@ -186,7 +218,8 @@ def cluster_atoms_DBSCAN(all_coords, predicted_probs, threshold=.5, eps=3, min_s
         Sorted cluster ids for all atoms with -1 representing non-site.
     """
 
-    predicted_labels = predicted_probs[:,1] > threshold
+    site_probs = site_probabilities(predicted_probs)
+    predicted_labels = site_probs > threshold
     if np.sum(predicted_labels) == 0:
         # No positive predictions were made with specified cutoff
         return None, None, None
@@ -195,13 +228,13 @@ def cluster_atoms_DBSCAN(all_coords, predicted_probs, threshold=.5, eps=3, min_s
         ms_clustering = DBSCAN(eps=eps, min_samples=min_samples).fit(bind_coords)
         cluster_ids = ms_clustering.labels_
         
-        sorted_ids = sort_clusters(cluster_ids, predicted_probs, predicted_labels, score_type=score_type)
+        sorted_ids = sort_clusters(cluster_ids, site_probs, predicted_labels, score_type=score_type)
     else:
         # Under rare circumstances only one atom may be predicted as the binding pocket. In this case
         # the clustering fails so we'll just call this one atom our best 'cluster'.
-        sorted_ids = [0]
+        sorted_ids = np.zeros(1, dtype=np.int32)
 
-    all_ids = -1*np.ones(predicted_labels.shape)
+    all_ids = np.full(predicted_labels.shape, -1, dtype=np.int32)
     all_ids[predicted_labels] = sorted_ids
 
     return bind_coords, sorted_ids, all_ids
@@ -245,38 +278,82 @@ def cluster_atoms_louvain(all_coords, adj_matrix, predicted_probs, threshold=.5,
         Sorted cluster ids for all atoms with -1 representing non-site.
     """
 
-    predicted_labels=predicted_probs[:,1] > threshold
-    
-    G = nx.from_scipy_sparse_array(adj_matrix, edge_attribute="distance")
-    prob_dict = {i:predicted_probs[i,1] for i in range(len(predicted_probs))}
-    nx.set_node_attributes(G, prob_dict, name='probability')
-    inverse_distance = nx.get_edge_attributes(G, name="distance")
-    inverse_distance = {k:-1*v for k, v in inverse_distance.items()}
-    nx.set_edge_attributes(G, inverse_distance, "inverse_distance")
-    
-    remove = [node for node,probability in G.nodes.data("probability") if probability < threshold]
-    G.remove_nodes_from(remove)
-    
+    site_probs = site_probabilities(predicted_probs)
+    predicted_labels = site_probs > threshold
     bind_coords = all_coords[predicted_labels]
     
-    # Cleanout anything larger than our cutoff
-    for u,v, dist in list(G.edges.data("distance")):
-        if dist > cutoff:
-            G.remove_edge(u,v)
-
+    # Only keep edges between site atoms that are within the cutoff before building the graph
+    site_adj = subgraph_adjacency(adj_matrix, predicted_labels)
+    site_adj.data[site_adj.data > cutoff] = 0
+    site_adj.eliminate_zeros()
+    G = nx.from_scipy_sparse_array(site_adj, edge_attribute="distance")
     
     communities = louvain_communities(G, resolution=resolution, weight=None)
     
-        
-    assignment_dict = {}
+    # Nodes are site atom indices, so communities can be written straight into the label array
+    cluster_ids = np.full(site_adj.shape[0], -1, dtype=np.int32)
     for i, ids in enumerate(communities):
-        for id in ids:
-            assignment_dict[id] = i
+        cluster_ids[np.fromiter(ids, dtype=int, count=len(ids))] = i
+        
+    sorted_ids = sort_clusters(cluster_ids, site_probs, predicted_labels, score_type=score_type)
+    
+    all_ids = np.full(predicted_labels.shape, -1, dtype=np.int32)
+    all_ids[predicted_labels] = sorted_ids
+
+    return bind_coords, sorted_ids, all_ids
+
+def cluster_atoms_connected(all_coords, adj_matrix, predicted_probs, threshold=.5, cutoff=5, score_type='mean'):
+    """Cluster atoms into sites as connected components of the site atom graph.
+
+    Parameters
+    ----------
+    all_coords: numpy.ndarray
+        Protein atomic coordinates.
+
+    adj_matrix: scipy.sparse.csr_matrix
+        Distance matrix to construct the graph for connected components.
         
-    cluster_ids = np.array([assignment_dict[k] for k in sorted(assignment_dict.keys())])
-    sorted_ids = sort_clusters(cluster_ids, predicted_probs, predicted_labels, score_type=score_type)
+    predicted_probs: numpy.ndarray
+        Model predicted binding site probabilities for each atom.
+
+    threshold: float
+        Probability threshold to classify atoms as site/non-site.
+
+    cutoff: float
+        Distance cutoff to connect atoms in the graph.
+
+    score_type: str
+        Option for atom score aggregation.
+
+    Returns
+    -------
+    numpy.ndarray
+        Coordinates of all binding site atoms.
     
-    all_ids = -1*np.ones(predicted_labels.shape)
+    numpy.ndarray
+        Sorted cluster ids for binding site atoms.
+
+
+    numpy.ndarray
+        Sorted cluster ids for all atoms with -1 representing non-site.
+    """
+
+    site_probs = site_probabilities(predicted_probs)
+    predicted_labels = site_probs > threshold
+    if np.sum(predicted_labels) == 0:
+        # No positive predictions were made with specified cutoff
+        return None, None, None
+    bind_coords = all_coords[predicted_labels]
+
+    # Only keep edges between site atoms that are within the cutoff
+    site_adj = subgraph_adjacency(adj_matrix, predicted_labels)
+    site_adj.data[site_adj.data > cutoff] = 0
+    site_adj.eliminate_zeros()
+
+    _, cluster_ids = connected_components(site_adj, directed=False)
+    sorted_ids = sort_clusters(cluster_ids, site_probs, predicted_labels, score_type=score_type)
+
+    all_ids = np.full(predicted_labels.shape, -1, dtype=np.int32)
     all_ids[predicted_labels] = sorted_ids
 
     return bind_coords, sorted_ids, all_ids
@@ -314,7 +391,8 @@ def cluster_atoms_single(all_coords, predicted_probs, threshold=.5, score_type='
         Sorted cluster ids for all atoms with -1 representing non-site.
     """
     
-    predicted_labels = predicted_probs[:,1] > threshold
+    site_probs = site_probabilities(predicted_probs)
+    predicted_labels = site_probs > threshold
     if np.sum(predicted_labels) == 0:
         # No positive predictions were made with specified cutoff
         return None, None, None
@@ -322,13 +400,13 @@ def cluster_atoms_single(all_coords, predicted_probs, threshold=.5, score_type='
     if bind_coords.shape[0] != 1:
         link_clustering = AgglomerativeClustering(linkage='single', **kwargs).fit(bind_coords)
         cluster_ids = link_clustering.labels_
-        sorted_ids = sort_clusters(cluster_ids, predicted_probs, predicted_labels, score_type=score_type)
+        sorted_ids = sort_clusters(cluster_ids, site_probs, predicted_labels, score_type=score_type)
     else:
         # Under rare circumstances only one atom may be predicted as the binding pocket. In this case
         # the clustering fails so we'll just call this one atom our best 'cluster'.
-        sorted_ids = np.ones(1)
+        sorted_ids = np.ones(1, dtype=np.int32)
 
-    all_ids = -1*np.ones(predicted_labels.shape) 
+    all_ids = np.full(predicted_labels.shape, -1, dtype=np.int32)
     all_ids[predicted_labels] = sorted_ids
 
     return bind_coords, sorted_ids, all_ids
@@ -366,7 +444,8 @@ def cluster_atoms_complete(all_coords, predicted_probs, threshold=.5, score_type
         Sorted cluster ids for all atoms with -1 representing non-site.
     """
 
-    predicted_labels = predicted_probs[:,1] > threshold
+    site_probs = site_probabilities(predicted_probs)
+    predicted_labels = site_probs > threshold
     if np.sum(predicted_labels) == 0:
         # No positive predictions were made with specified cutoff
         return None, None, None
@@ -374,13 +453,13 @@ def cluster_atoms_complete(all_coords, predicted_probs, threshold=.5, score_type
     if bind_coords.shape[0] != 1:
         link_clustering = AgglomerativeClustering(linkage='complete', **kwargs).fit(bind_coords)
         cluster_ids = link_clustering.labels_
-        sorted_ids = sort_clusters(cluster_ids, predicted_probs, predicted_labels, score_type=score_type)
+        sorted_ids = sort_clusters(cluster_ids, site_probs, predicted_labels, score_type=score_type)
     else:
         # Under rare circumstances only one atom may be predicted as the binding pocket. In this case
         # the clustering fails so we'll just call this one atom our best 'cluster'.
-        sorted_ids = np.ones(1)
+        sorted_ids = np.ones(1, dtype=np.int32)
 
-    all_ids = -1*np.ones(predicted_labels.shape) 
+    all_ids = np.full(predicted_labels.shape, -1, dtype=np.int32)
     all_ids[predicted_labels] = sorted_ids
 
     return bind_coords, sorted_ids, all_ids
@@ -418,7 +497,8 @@ def cluster_atoms_average(all_coords, predicted_probs, threshold=.5, score_type=
         Sorted cluster ids for all atoms with -1 representing non-site.
     """
 
-    predicted_labels = predicted_probs[:,1] > threshold
+    site_probs = site_probabilities(predicted_probs)
+    predicted_labels = site_probs > threshold
     if np.sum(predicted_labels) == 0:
         # No positive predictions were made with specified cutoff
         return None, None, None
@@ -426,13 +506,13 @@ def cluster_atoms_average(all_coords, predicted_probs, threshold=.5, score_type=
     if bind_coords.shape[0] != 1:
         link_clustering = AgglomerativeClustering(linkage='average', **kwargs).fit(bind_coords)
         cluster_ids = link_clustering.labels_
-        sorted_ids = sort_clusters(cluster_ids, predicted_probs, predicted_labels, score_type=score_type)
+        sorted_ids = sort_clusters(cluster_ids, site_probs, predicted_labels, score_type=score_type)
     else:
         # Under rare circumstances only one atom may be predicted as the binding pocket. In this case
         # the clustering fails so we'll just call this one atom our best 'cluster'.
-        sorted_ids = np.ones(1)
+        sorted_ids = np.ones(1, dtype=np.int32)
 
-    all_ids = -1*np.ones(predicted_labels.shape) 
+    all_ids = np.full(predicted_labels.shape, -1, dtype=np.int32)
     all_ids[predicted_labels] = sorted_ids
 
     return bind_coords, sorted_ids, all_ids
@@ -470,8 +550,8 @@ def cluster_atoms_ward(all_coords, predicted_probs, threshold=.5, score_type='me
         Sorted cluster ids for all atoms with -1 representing non-site.
     """
 
-    predicted_labels = predicted_probs[:,1] >= threshold
-    site_probs = predicted_probs[:,1]
+    site_probs = site_probabilities(predicted_probs).copy()
+    predicted_labels = site_probs >= threshold
     site_probs[site_probs < threshold] = 0
     connectivity = radius_neighbors_graph(all_coords, 5, mode='distance')
     if np.sum(predicted_labels) == 0:
@@ -493,9 +573,9 @@ def cluster_atoms_ward(all_coords, predicted_probs, threshold=.5, score_type='me
     else:
         # Under rare circumstances only one atom may be predicted as the binding pocket. In this case
         # the clustering fails so we'll just call this one atom our best 'cluster'.
-        sorted_ids = np.ones(1)
+        sorted_ids = np.ones(1, dtype=np.int32)
 
-    all_ids = -1*np.ones(predicted_labels.shape)
+    all_ids = np.full(predicted_labels.shape, -1, dtype=np.int32)
     all_ids[predicted_labels] = sorted_ids
 
     return bind_coords, sorted_ids, all_ids 
@@ -538,7 +618,8 @@ def cluster_atoms_groundtruth(all_coords, lig_coord_list, predicted_probs, thres
         Sorted cluster ids for all atoms with -1 representing non-site.
     """
 
-    predicted_labels = predicted_probs[:,1] > threshold
+    site_probs = site_probabilities(predicted_probs)
+    predicted_labels = site_probs > threshold
     if np.sum(predicted_labels) == 0:
         # No positive predictions were made with specified cutoff
         return None, None, None
@@ -547,14 +628,14 @@ def cluster_atoms_groundtruth(all_coords, lig_coord_list, predicted_probs, thres
     all_lig_coords = np.row_stack(lig_coord_list)
     ligand_distance = np.min(distance_array(bind_coords, all_lig_coords), axis=1)
     closest_ligand_atom = np.argmin(distance_array(bind_coords, all_lig_coords), axis=1)
-    atom_to_ligand_map = np.concatenate([i*np.ones(len(lig_coord_list[i])) for i in range(len(lig_coord_list))])
+    atom_to_ligand_map = np.concatenate([np.full(len(lig_coord_list[i]), i, dtype=np.int32) for i in range(len(lig_coord_list))])
     cluster_ids = atom_to_ligand_map[closest_ligand_atom]
     cluster_ids[ligand_distance > distance_threshold] = -1
-    sorted_ids = sort_clusters(cluster_ids, predicted_probs, predicted_labels, score_type=score_type)
+    sorted_ids = sort_clusters(cluster_ids, site_probs, predicted_labels, score_type=score_type)
 
 
 
-    all_ids = -1*np.ones(predicted_labels.shape) 
+    all_ids = np.full(predicted_labels.shape, -1, dtype=np.int32)
     all_ids[predicted_labels] = sorted_ids
 
     return bind_coords, sorted_ids, all_ids
@@ -573,21 +654,14 @@ def hull_center(hull):
         Convex hull center of mass.
     """
 
-    hull_com = np.zeros(3)
     tetras = Delaunay(hull.points[hull.vertices])
+    tetra_verts = tetras.points[tetras.simplices] # (n_tetras, 4, 3)
 
-    for i in range(len(tetras.simplices)):
-        tetra_verts = tetras.points[tetras.simplices][i]
-
-        a, b, c, d = tetra_verts
-        a, b, c = a - d, b - d, c - d
-        tetra_vol = np.abs(np.linalg.det([a, b, c])) / 6
-
-        tetra_com = np.mean(tetra_verts, axis=0)
+    edges = tetra_verts[:, :3, :] - tetra_verts[:, 3:4, :]
+    tetra_vols = np.abs(np.linalg.det(edges)) / 6
+    tetra_coms = np.mean(tetra_verts, axis=1)
 
-        hull_com += tetra_com * tetra_vol
-
-    hull_com = hull_com / hull.volume
+    hull_com = np.sum(tetra_coms * tetra_vols[:, None], axis=0) / hull.volume
     return hull_com
 
 def get_centroid(coords):
@@ -606,28 +680,6 @@ def get_centroid(coords):
 
     return np.mean(coords, axis=0)
 
-def DCA_dist(center, lig_coords):
-    """Compute the distance to the nearest ligand heavy atom for a binding site center.
-
-    Parameters
-    ----------
-    center: numpy.ndarray
-        Binding site center.
-    
-    lig_coords: numpy.ndarray
-        Heavy atom coordinates for all ligands.
-
-    Returns
-    -------
-    numpy.ndarray
-        Minimum distance from site center to ligand heavy atoms.
-    """
-
-    distances = np.sqrt(np.sum((center - lig_coords)**2, axis=1))
-    shortest = np.min(distances)
-    
-    return shortest
-
 def hulls_from_clusters(bind_coords, sorted_ids, n_sites):
     """Compute the convex hull for each binding site cluster.
 
@@ -664,12 +716,17 @@ def hulls_from_clusters(bind_coords, sorted_ids, n_sites):
             if c_id >= 0:
                 predicted_points = bind_coords[sorted_ids == c_id]
                 predicted_points_list.append(predicted_points)
-                if len(predicted_points) < 4:  # You need four points to define a convex hull
+                predicted_hull = None
+                if len(predicted_points) >= 4:  # You need four points to define a convex hull
+                    try:
+                        predicted_hull = ConvexHull(predicted_points)
+                    except QhullError:
+                        # Flat (coplanar or collinear) sites have no volume so they are treated like small sites
+                        pass
+                predicted_hull_list.append(predicted_hull)
+                if predicted_hull is None:
                     predicted_center_list.append(get_centroid(predicted_points))
-                    predicted_hull_list.append(None)
                 else:
-                    predicted_hull = ConvexHull(predicted_points)
-                    predicted_hull_list.append(ConvexHull(predicted_points))
                     predicted_center_list.append(hull_center(predicted_hull))
 
     return predicted_points_list, predicted_hull_list, predicted_center_list
@@ -702,12 +759,13 @@ def center_of_probability(bind_coords, bind_probs, sorted_ids, n_sites, type='pr
 
     top_ids = np.unique(sorted_ids)[::-1][:n_sites]
     predicted_center_list = []
+    bind_probs = site_probabilities(bind_probs)
     
     for c_id in top_ids:
         if c_id is not None:
             if c_id >= 0:
                 predicted_points = bind_coords[sorted_ids == c_id]
-                cluster_probs = bind_probs[:,1][sorted_ids == c_id]
+                cluster_probs = bind_probs[sorted_ids == c_id]
                 if type == 'square':
                     cluster_probs = cluster_probs**2
                 if type == "centroid":
@@ -726,7 +784,7 @@ def subgraph_adjacency(adjacency, indices):
         Original adjacency matrix.
     
     indices: numpy.ndarray
-        Subset of indices for inducing the subgraph.
+        Subset of indices (or boolean mask) for inducing the subgraph.
 
     Returns
     -------
@@ -734,7 +792,11 @@ def subgraph_adjacency(adjacency, indices):
         Subgraph adjacency matrix.
     """
     
-    return adjacency[indices].T[indices].T
+    indices = np.asarray(indices)
+    if indices.dtype == bool:
+        indices = np.flatnonzero(indices)
+
+    return adjacency[indices][:, indices]
 
 def convert_atom_indices_to_array_indices(input_atom_order, atom_array):
     """Convert the indexing from protein atoms to Connolly surface.
@@ -792,8 +854,9 @@ def get_clusters_from_connolly(connolly_vertices, connolly_atoms, tracked_indice
         Mesh predicted probabilites.
     """
 
-    predicted_labels = predicted_probs[:,1] > threshold
-    predicted_probs = predicted_probs[predicted_labels]
+    site_probs = site_probabilities(predicted_probs)
+    predicted_labels = site_probs > threshold
+    predicted_probs = site_probs[predicted_labels]
     tracked_indices = tracked_indices[predicted_labels]
     
     selected_connolly = np.isin(connolly_atoms, tracked_indices)
@@ -858,11 +921,48 @@ def scPDB_ligand_merge(lig_coord_list, lig_mass_list, lig_center_list):
     
     return new_coords, new_centers
 
+def ligand_geometry(lig_coord_list, lig_mass_list, ligand_merge=False):
+    """Compute the ligand centers and nearest atom search trees used to score predicted sites.
+
+    These only depend on the ligands, so they can be computed once per system and reused for every clustering setting.
+
+    Parameters
+    ----------
+    lig_coord_list: list of numpy.ndarrays
+        Heavy atom coordinates for each ligand.
+    
+    lig_mass_list: list of numpy.ndarrays
+        Heavy atom masses for each ligand.
+
+    ligand_merge: bool
+        Whether to merge ligands with center of mass within 5 A as is done in scPDB.
+    
+    Returns
+    -------
+    list of numpy.ndarrays
+        Heavy atom coordinates for each ligand after optional merging.
+    
+    list of numpy.ndarrays
+        Heavy atom center of mass for each ligand after optional merging.
+
+    list of scipy.spatial.cKDTree
+        Nearest atom search tree for each ligand after optional merging.
+    """
+
+    lig_center_list = [center_of_mass(lig_coord_list[i], lig_mass_list[i]) for i in range(len(lig_coord_list))]
+
+    if ligand_merge:
+        lig_coord_list, lig_center_list = scPDB_ligand_merge(lig_coord_list, lig_mass_list, lig_center_list)
+
+    lig_trees = [cKDTree(lig_coords) for lig_coords in lig_coord_list]
+
+    return lig_coord_list, lig_center_list, lig_trees
+
 
 def multisite_metrics(prot_coords, lig_coord_list, lig_mass_list, predicted_probs, top_n_plus=0, 
 threshold=.5, eps=3, resolution=0.05, method="louvain", score_type="mean", centroid_type="hull", 
 cluster_all=False, adj_matrix=None, surf_mask=None, connolly_data=None, tracked_indices=None, 
-ligand_merge=False, known_n_sites=True):
+ligand_merge=False, known_n_sites=True, lig_geometry=None):
     """Cluster multiple binding sites and calculate distance from each ligand.
 
     Parameters
@@ -876,8 +976,8 @@ ligand_merge=False, known_n_sites=True):
     lig_mass_list: list of numpy.ndarrays
         Ligand atomic masses for each ligand.
 
-    predicted_probs: list of numpy.ndarrays
-        Class probabilities for not site in column 0 and site in column 1.
+    predicted_probs: numpy.ndarray
+        Class probabilities for not site in column 0 and site in column 1 (or site probabilities alone).
         
     top_n_plus: int
         Number of predicted sites to include compared to number of true sites (eg. 1 means 1 more predicted).
@@ -904,7 +1004,7 @@ ligand_merge=False, known_n_sites=True):
         Whether to assign points outside kernels to the nearest cluster or leave them unlabeled.
 
     adj_matrix: numpy.ndarray
-        Adjacency for Louvain community detection.
+        Adjacency for Louvain community detection or connected components.
 
     surf_mask: numpy.ndarray
         Mask for selecting only surface atoms.
@@ -921,6 +1021,9 @@ ligand_merge=False, known_n_sites=True):
     known_n_sites: bool
         Whether to use the ground truth number of sites (True) or a static maximum (False).
 
+    lig_geometry: tuple
+        Precomputed output of ligand_geometry (computed from the ligand lists if None).
+
     Returns
     -------
     numpy.ndarray
@@ -936,9 +1039,11 @@ ligand_merge=False, known_n_sites=True):
         Number of sites predicted within the limit (top N+M or static M).
     """
 
+    predicted_probs = site_probabilities(predicted_probs)
+
     if surf_mask is not None:
         prot_coords = prot_coords[surf_mask]
-        if method == "louvain":
+        if method in ["louvain", "connected"]:
             adj_matrix = subgraph_adjacency(adj_matrix, surf_mask)
     if connolly_data is not None:
         connolly_vertices = connolly_data['vertices']
@@ -951,6 +1056,8 @@ ligand_merge=False, known_n_sites=True):
         bind_coords, sorted_ids, all_ids = cluster_atoms_DBSCAN(prot_coords, predicted_probs, threshold=threshold, eps=eps, score_type=score_type)
     elif method == "louvain":
         bind_coords, sorted_ids, all_ids = cluster_atoms_louvain(prot_coords,adj_matrix,predicted_probs,threshold=threshold, cutoff=eps, resolution=resolution, score_type=score_type)
+    elif method == "connected":
+        bind_coords, sorted_ids, all_ids = cluster_atoms_connected(prot_coords, adj_matrix, predicted_probs, threshold=threshold, cutoff=eps, score_type=score_type)
     elif method == "single":
         bind_coords, sorted_ids, all_ids = cluster_atoms_single(prot_coords, predicted_probs, threshold=threshold, n_clusters=None, distance_threshold=eps, score_type=score_type)
     elif method == "complete":
@@ -965,10 +1072,9 @@ ligand_merge=False, known_n_sites=True):
     if connolly_data is not None:
         bind_coords, sorted_ids, predicted_probs = get_clusters_from_connolly(connolly_vertices, connolly_atoms, tracked_indices, sorted_ids, predicted_probs, threshold)
         
-    lig_center_list = [center_of_mass(lig_coord_list[i], lig_mass_list[i]) for i in range(len(lig_coord_list))]
-
-    if ligand_merge:
-        lig_coord_list, lig_center_list = scPDB_ligand_merge(lig_coord_list, lig_mass_list, lig_center_list)
+    if lig_geometry is None:
+        lig_geometry = ligand_geometry(lig_coord_list, lig_mass_list, ligand_merge=ligand_merge)
+    lig_coord_list, lig_center_list, lig_trees = lig_geometry
 
     if known_n_sites: n_sites = len(lig_center_list)
     else: n_sites = 0 # just use the static term
@@ -976,7 +1082,7 @@ ligand_merge=False, known_n_sites=True):
     if centroid_type == "hull":
         _, _, predicted_center_list = hulls_from_clusters(bind_coords, sorted_ids, n_sites+top_n_plus)
     else:
-        bind_probs = predicted_probs[predicted_probs[:,1] > threshold]
+        bind_probs = predicted_probs[predicted_probs > threshold]
         predicted_center_list = center_of_probability(bind_coords, bind_probs, sorted_ids, n_sites+top_n_plus, type=centroid_type)
 
     if type(sorted_ids) == type(None):
@@ -987,18 +1093,11 @@ ligand_merge=False, known_n_sites=True):
         top_predicted = len(predicted_center_list)
 
     if len(predicted_center_list) > 0:          
-        DCC_lig_matrix = np.zeros([len(lig_center_list), len(predicted_center_list)])
-        DCA_matrix = np.zeros([len(lig_center_list), len(predicted_center_list)])
+        predicted_centers = np.array(predicted_center_list)
 
-        for index, x in np.ndenumerate(DCA_matrix):
-            true_ind, pred_ind = index
-
-            predicted_center = predicted_center_list[pred_ind]
-            lig_center = lig_center_list[true_ind]
-            lig_coords = lig_coord_list[true_ind]
-
-            DCC_lig_matrix[index] = np.sqrt(np.sum((predicted_center - lig_center)**2))
-            DCA_matrix[index] = DCA_dist(predicted_center, lig_coords)
+        # Rows are ligands, columns are predicted sites
+        DCC_lig_matrix = cdist(np.array(lig_center_list), predicted_centers)
+        DCA_matrix = np.array([lig_tree.query(predicted_centers)[0] for lig_tree in lig_trees])
 
         DCC_lig = np.min(DCC_lig_matrix, axis=1)
         DCA = np.min(DCA_matrix, axis=1)
@@ -1012,18 +1111,122 @@ ligand_merge=False, known_n_sites=True):
         return nan_arr, nan_arr, n_predicted, top_predicted
 
 
-def compute_metrics_for_all(path_to_mol2, path_to_labels, top_n_plus=0, threshold = 0.5, eps=3, resolution=0.05,
-method="louvain", score_type="mean", centroid_type="hull", cluster_all=False, use_surface=False, use_connolly=False, 
-ligand_merge=False, known_n_sites=True):
-    """Cluster multiple binding sites and calculate distance from each ligand.
+def load_assembly(file, path_to_mol2, use_surface=False, use_connolly=False, ligand_merge=False, load_adjacency=True, adj_cutoff=None):
+    """Load the protein, predictions, and ligands for a single system.
+
+    Nothing loaded here depends on the clustering parameters, so each system only needs to be loaded once per parameter sweep.
 
     Parameters
     ----------
+    file: str
+        System file path.
+
     path_to_mol2: str
         Path to protein mol2 files.
 
-    path_to_labels: str
-        Path to atomic class (site/non-site) labels.
+    use_surface: bool
+        Whether to only use surface atoms.
+
+    use_connolly: bool
+        Whether to use a Connolly surface mesh.
+
+    ligand_merge: bool
+        Whether to merge ligands with center of mass within 5 A as is done in scPDB.
+
+    load_adjacency: bool
+        Whether to load the atom adjacency (only needed for graph-based clustering).
+
+    adj_cutoff: float
+        Drop adjacency edges longer than this distance (keep all edges if None).
+
+    Returns
+    -------
+    dict
+        System data to be scored with score_assembly.
+    """
+
+    assembly_name = file.split('.')[-2]
+    try:
+        trimmed_protein = mda.Universe(path_to_mol2 + assembly_name + '.mol2')
+        labels = np.load(prepend + metric_dir + '/labels/' + model_name + '/' + assembly_name + '.npy')
+        probs = np.load(prepend + metric_dir + '/probs/' + model_name + '/' + assembly_name + '.npy')
+        atom_indices = np.load(prepend + metric_dir + '/indices/' + model_name + '/' + assembly_name + '.npy')
+
+        surf_mask = None
+        connolly_data = None
+        tracked_indices = None
+        if use_surface: 
+            surf_mask = np.load(prepend + metric_dir + '/SASAs/'  + assembly_name + '.npy')
+        if use_connolly:
+            connolly_dir = '/'.join(path_to_mol2.split('/')[:-2])+'/connolly'
+            connolly_data = dict(np.load(f'{connolly_dir}/{assembly_name}.npz'))
+            tracked_indices = atom_indices
+
+        if is_label: probs = labels
+
+        lig_coord_list = []
+        lig_mass_list = []
+        
+        for file_path in sorted(glob(data_dir + '/ready_to_parse_mol2/' + assembly_name + '/*')):
+            if 'ligand' in file_path.split('/')[-1] and not 'site' in file_path.split('/')[-1]:
+                ligand = mda.Universe(file_path)
+                lig_coord_list.append(ligand.atoms.positions)
+                lig_mass_list.append(ligand.atoms.masses)
+
+        adj_matrix = None
+        if load_adjacency:
+            adj_matrix = np.load(data_dir+'/raw/' + assembly_name + '.npz', allow_pickle=True)['adj_matrix'].item()
+            adj_matrix = subgraph_adjacency(adj_matrix, atom_indices)
+            if adj_cutoff is not None:
+                adj_matrix.data[adj_matrix.data > adj_cutoff] = 0
+                adj_matrix.eliminate_zeros()
+
+        return {'file': file, 'name': assembly_name, 'prot_coords': trimmed_protein.atoms[atom_indices].positions,
+            'lig_coord_list': lig_coord_list, 'lig_mass_list': lig_mass_list, 
+            'lig_geometry': ligand_geometry(lig_coord_list, lig_mass_list, ligand_merge=ligand_merge),
+            'probs': site_probabilities(probs), 'adj_matrix': adj_matrix, 'surf_mask': surf_mask, 
+            'connolly_data': connolly_data, 'tracked_indices': tracked_indices}
+
+    except Exception as e:
+        print("ERROR")
+        print(assembly_name, flush=True)
+        raise e
+
+def cache_assembly(file, cache_dir, path_to_mol2, **kwargs):
+    """Load a single system and write it to the on-disk cache.
+
+    Parameters
+    ----------
+    file: str
+        System file path.
+
+    cache_dir: str
+        Directory to write the loaded system to.
+
+    path_to_mol2: str
+        Path to protein mol2 files.
+
+    **kwargs
+        Passed on to load_assembly.
+
+    Returns
+    -------
+    str
+        Path of the cached system.
+    """
+
+    cache_path = f"{cache_dir}/{file.split('.')[-2]}.joblib"
+    dump(load_assembly(file, path_to_mol2, **kwargs), cache_path)
+    return cache_path
+
+def score_assembly(cache_path, top_n_plus=0, threshold = 0.5, eps=3, resolution=0.05, method="louvain", score_type="mean", 
+centroid_type="hull", cluster_all=False, known_n_sites=True):
+    """Cluster binding sites for a loaded system and calculate distance from each ligand.
+
+    Parameters
+    ----------
+    cache_path: str
+        Path of a system cached by cache_assembly.
         
     top_n_plus: int
         Number of predicted sites to include compared to number of true sites (eg. 1 means 1 more predicted).
@@ -1049,6 +1252,61 @@ ligand_merge=False, known_n_sites=True):
     cluster_all: bool
         Whether to assign points outside kernels to the nearest cluster or leave them unlabeled.
 
+    known_n_sites: bool
+        Whether to use the ground truth number of sites (True) or a static maximum (False).
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of distances from predicted site center to ligand center of mass. 
+        
+    numpy.ndarray
+        Array of closest distances from predicted site center to any ligand heavy atom. 
+
+    int
+        Total number of binding sites predicted.
+
+    int 
+        Number of sites predicted within the limit (top N+M or static M).
+
+    int
+        Number of systems without predictions.
+    """
+
+    assembly = load(cache_path)
+    no_prediction_count = 0
+    try:
+        DCC_lig, DCA, n_predicted, top_predicted = multisite_metrics(assembly['prot_coords'], assembly['lig_coord_list'], assembly['lig_mass_list'],
+            assembly['probs'], top_n_plus=top_n_plus, threshold=threshold, eps=eps, resolution=resolution, method=method, score_type=score_type,
+            centroid_type=centroid_type, cluster_all=cluster_all, adj_matrix=assembly['adj_matrix'], surf_mask=assembly['surf_mask'], 
+            connolly_data=assembly['connolly_data'], tracked_indices=assembly['tracked_indices'], known_n_sites=known_n_sites, 
+            lig_geometry=assembly['lig_geometry'])
+
+        if np.all(np.isnan(DCC_lig)) and np.all(np.isnan(DCA)): 
+            no_prediction_count += 1
+        return DCC_lig, DCA, n_predicted, top_predicted, no_prediction_count
+
+    except Exception as e:
+        print("ERROR")
+        print(assembly['name'], flush=True)
+        raise e
+
+def load_all_assemblies(path_to_mol2, path_to_labels, cache_dir, use_surface=False, use_connolly=False, ligand_merge=False, load_adjacency=True, adj_cutoff=None):
+    """Load every system with predictions and cache it on disk so it can be scored repeatedly.
+
+    Systems are kept on disk rather than in memory, so workers only receive a file path for each setting in the sweep.
+
+    Parameters
+    ----------
+    path_to_mol2: str
+        Path to protein mol2 files.
+
+    path_to_labels: str
+        Path to atomic class (site/non-site) labels.
+
+    cache_dir: str
+        Directory to write the loaded systems to.
+
     use_surface: bool
         Whether to only use surface atoms.
 
@@ -1058,6 +1316,56 @@ ligand_merge=False, known_n_sites=True):
     ligand_merge: bool
         Whether to merge ligands with center of mass within 5 A as is done in scPDB.
 
+    load_adjacency: bool
+        Whether to load the atom adjacency (only needed for graph-based clustering).
+
+    adj_cutoff: float
+        Drop adjacency edges longer than this distance (keep all edges if None).
+
+    Returns
+    -------
+    list of tuples
+        System file name and cache path for each system.
+    """
+
+    files = os.listdir(path_to_labels)
+    cache_paths = Parallel(n_jobs=n_jobs)(delayed(cache_assembly)(file, cache_dir, path_to_mol2, use_surface=use_surface, use_connolly=use_connolly, 
+        ligand_merge=ligand_merge, load_adjacency=load_adjacency, adj_cutoff=adj_cutoff) for file in tqdm(files,  position=0, leave=True))
+    return list(zip(files, cache_paths))
+
+def compute_metrics_for_all(assemblies, top_n_plus=0, threshold = 0.5, eps=3, resolution=0.05, method="louvain", score_type="mean", 
+centroid_type="hull", cluster_all=False, known_n_sites=True):
+    """Cluster multiple binding sites and calculate distance from each ligand.
+
+    Parameters
+    ----------
+    assemblies: list of tuples
+        System file names and cache paths from load_all_assemblies.
+        
+    top_n_plus: int
+        Number of predicted sites to include compared to number of true sites (eg. 1 means 1 more predicted).
+
+    threshold: float
+        Probability threshold to predict binding site atoms.
+
+    eps: float
+        Distance threshold used for clustering.
+
+    resolution: float
+        Resolution only used for Louvain communuty detection.
+
+    method: str
+        Clustering method to use.
+
+    score_type: str
+        Score function to aggregate atomic scores into site scores.
+
+    centroid_type: str
+        Function to compute the site centers.
+
+    cluster_all: bool
+        Whether to assign points outside kernels to the nearest cluster or leave them unlabeled.
+
     known_n_sites: bool
         Whether to use the ground truth number of sites (True) or a static maximum (False).
 
@@ -1082,82 +1390,11 @@ ligand_merge=False, known_n_sites=True):
         System names.
     """
 
-    DCC_lig_list = []
-    DCA_list = []
-
-    def helper(file):
-        """Helper function to load and analyze each system.
-
-        Parameters
-        ----------
-        file: str
-            System file path.
-
-        Returns
-        -------
-        numpy.ndarray
-            Array of distances from predicted site center to ligand center of mass. 
-            
-        numpy.ndarray
-            Array of closest distances from predicted site center to any ligand heavy atom. 
-
-        int
-            Total number of binding sites predicted.
-
-        int 
-            Number of sites predicted within the limit (top N+M or static M).
-
-        int
-            Number of systems without predictions.
-        """
-
-        no_prediction_count = 0
-        assembly_name = file.split('.')[-2]
-        try:
-            trimmed_protein = mda.Universe(path_to_mol2 + assembly_name + '.mol2')
-            labels = np.load(prepend + metric_dir + '/labels/' + model_name + '/' + assembly_name + '.npy')
-            probs = np.load(prepend + metric_dir + '/probs/' + model_name + '/' + assembly_name + '.npy')
-            atom_indices = np.load(prepend + metric_dir + '/indices/' + model_name + '/' + assembly_name + '.npy')
-
-            surf_mask = None
-            connolly_data = None
-            tracked_indices = None
-            if use_surface: 
-                surf_mask = np.load(prepend + metric_dir + '/SASAs/'  + assembly_name + '.npy')
-            if use_connolly:
-                connolly_dir = '/'.join(path_to_mol2.split('/')[:-2])+'/connolly'
-                connolly_data = np.load(f'{connolly_dir}/{assembly_name}.npz')
-                tracked_indices = atom_indices
-
-            if is_label: probs = labels
-
-            lig_coord_list = []
-            lig_mass_list = []
-            
-            for file_path in sorted(glob(data_dir + '/ready_to_parse_mol2/' + assembly_name + '/*')):
-                if 'ligand' in file_path.split('/')[-1] and not 'site' in file_path.split('/')[-1]:
-                    ligand = mda.Universe(file_path)
-                    lig_coord_list.append(list(ligand.atoms.positions))
-                    lig_mass_list.append(list(ligand.atoms.masses))
-            adj_matrix = np.load(data_dir+'/raw/' + assembly_name + '.npz', allow_pickle=True)['adj_matrix'].item()
-            adj_matrix = subgraph_adjacency(adj_matrix, atom_indices)
-            DCC_lig, DCA, n_predicted, top_predicted = multisite_metrics(trimmed_protein.atoms[atom_indices].positions, lig_coord_list, lig_mass_list,
-                probs, top_n_plus=top_n_plus, threshold=threshold, eps=eps, resolution=resolution, method=method, score_type=score_type,
-                centroid_type=centroid_type, cluster_all=cluster_all, adj_matrix=adj_matrix, surf_mask=surf_mask, connolly_data=connolly_data,
-                tracked_indices=tracked_indices, ligand_merge=ligand_merge, known_n_sites=known_n_sites)
-
-            if np.all(np.isnan(DCC_lig)) and np.all(np.isnan(DCA)): 
-                no_prediction_count += 1
-            return DCC_lig, DCA, n_predicted, top_predicted, no_prediction_count
-
-        except Exception as e:
-            print("ERROR")
-            print(assembly_name, flush=True)
-            raise e
-
-    r = Parallel(n_jobs=n_jobs)(delayed(helper)(file) for file in tqdm(os.listdir(path_to_labels)[:],  position=0, leave=True))
+    r = Parallel(n_jobs=n_jobs)(delayed(score_assembly)(cache_path, top_n_plus=top_n_plus, threshold=threshold, eps=eps, resolution=resolution, 
+        method=method, score_type=score_type, centroid_type=centroid_type, cluster_all=cluster_all, known_n_sites=known_n_sites) 
+        for _, cache_path in tqdm(assemblies,  position=0, leave=True))
     DCC_lig_list, DCA_list, n_predicted, top_predicted, no_prediction_count = zip(*r)
-    names = [file for file in os.listdir(path_to_labels)]
+    names = [file for file, _ in assemblies]
     return DCC_lig_list, DCA_list, n_predicted, top_predicted, no_prediction_count, names
 
 def criteria_to_metrics(metric_array, top_predicted):
@@ -1196,7 +1433,7 @@ if __name__ == "__main__":
     parser.add_argument("test_set", choices=["val", "coach420", "coach420_mlig", "coach420_intersect",
      "holo4k", "holo4k_mlig", "holo4k_intersect", "holo4k_chains"], help="Test set.")
     parser.add_argument("model_name", help="Model file path.")
-    parser.add_argument("-c", "--clustering_method", default="average", choices=["meanshift", "dbscan", "louvain", "single", "complete", "average", "ward", "groundtruth"], help="Clustering method.")
+    parser.add_argument("-c", "--clustering_method", default="average", choices=["meanshift", "dbscan", "louvain", "connected", "single", "complete", "average", "ward", "groundtruth"], help="Clustering method.")
     parser.add_argument("-d", "--dist_thresholds", type=float, nargs="+", default=[15], help="Distance thresholds for clustering.")
     parser.add_argument("-p", "--prob_threshold", type=float, default=.3, help="Probability threshold for atom classification.")
     parser.add_argument("-np", "--top_n_plus", type=int, nargs="+", default=[0,2,1000], help="Number of additional sites to consider.")
@@ -1260,7 +1497,7 @@ if __name__ == "__main__":
         all_labels = np.load(all_label_path + "all_labels.npz")['arr_0']
         start = time.time()
 
-        binarized_labels = np.array([[0,1] if x == 1 else [1,0] for x in all_labels])
+        binarized_labels = np.eye(2, dtype=int)[(all_labels == 1).astype(int)] # one-hot rows, [0,1] for site atoms
         # Compute roc, auc and optimal threshold
         all_probs = np.array(all_probs, dtype=object)
 
@@ -1324,127 +1561,151 @@ if __name__ == "__main__":
     if os.path.exists(outfile):
         os.remove(outfile)
     out = open(outfile, 'a')
-    for eps in eps_list:
-        for top_n_plus in top_n_list:
-            print(f"Calculating n+{top_n_plus} metrics for {threshold} threshold with distance cutoff {eps}.", flush=True)
-            out.write(f"Calculating n+{top_n_plus} metrics for {threshold} threshold with distance cutoff {eps}.\n")
-            start = time.time()
-            path_to_mol2= data_dir + '/mol2/'
-            path_to_labels= prepend + metric_dir + '/labels/' + model_name + '/'
-            DCC_lig, DCA, n_predicted, top_predicted, no_prediction_count, names = compute_metrics_for_all(
-            path_to_mol2, path_to_labels, top_n_plus=top_n_plus, threshold=threshold, eps=eps, resolution=resolution,
-            method=method, score_type=score_type, centroid_type=centroid_type, use_surface=use_surface, use_connolly=use_connolly, ligand_merge=ligand_merge)
-
-            print("Done. {}".format(time.time()- start))
-            out.write("Done. {}\n".format(time.time()- start))
+
+    # Systems are loaded once and cached on disk for every clustering setting in the sweep
+    print("Loading systems.", flush=True)
+    start = time.time()
+    path_to_mol2= data_dir + '/mol2/'
+    path_to_labels= prepend + metric_dir + '/labels/' + model_name + '/'
+    graph_method = method in ["louvain", "connected"]
+    cache_dir = tempfile.mkdtemp(prefix='systems_', dir=outdir)
+    # Turn SIGTERM (e.g. a SLURM time limit) into SystemExit so the cache is still cleaned up
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    try:
+        assemblies = load_all_assemblies(path_to_mol2, path_to_labels, cache_dir, use_surface=use_surface, use_connolly=use_connolly, 
+            ligand_merge=ligand_merge, load_adjacency=graph_method, adj_cutoff=max(eps_list) if graph_method else None)
+        print("Done. {}".format(time.time()- start))
+
+        # Overlap files are written on a background thread while the next setting is computed
+        io_pool = ThreadPoolExecutor(max_workers=1)
+        io_futures = []
+
+        for eps in eps_list:
+            for top_n_plus in top_n_list:
+                print(f"Calculating n+{top_n_plus} metrics for {threshold} threshold with distance cutoff {eps}.", flush=True)
+                out.write(f"Calculating n+{top_n_plus} metrics for {threshold} threshold with distance cutoff {eps}.\n")
+                start = time.time()
+                DCC_lig, DCA, n_predicted, top_predicted, no_prediction_count, names = compute_metrics_for_all(
+                assemblies, top_n_plus=top_n_plus, threshold=threshold, eps=eps, resolution=resolution,
+                method=method, score_type=score_type, centroid_type=centroid_type)
+
+                print("Done. {}".format(time.time()- start))
+                out.write("Done. {}\n".format(time.time()- start))
             
-            overlap_path = f"{prepend}{metric_dir}/overlaps/{model_name}"
-            if not os.path.isdir(overlap_path):
-                os.makedirs(overlap_path)
+                overlap_path = f"{prepend}{metric_dir}/overlaps/{model_name}"
+                if not os.path.isdir(overlap_path):
+                    os.makedirs(overlap_path)
             
 
-            np.savez(f"{overlap_path}/{argstring}_n+{top_n_plus}.npz", DCC_lig=np.array(DCC_lig, dtype=object), DCA=np.array(DCA, dtype=object),
-             n_predicted=n_predicted, names=names)
-
-            n_predicted = np.array(n_predicted)
-
-            print("-----------------------------------------------------------------------------------", flush=True)
-            print(f"Method: {method}")
-            print(f"Cutoff (Prediction Threshold): {threshold}")
-            print(f"EPS: {eps}")
-            print(f"top n + {top_n_plus} prediction")
-            print("-----------------------------------------------------------------------------------", flush=True)
-            print(f"Number of systems with no predictions: {np.sum(no_prediction_count)}", flush=True)
-
-            out.write(f"Method: {method}\n")
-            out.write("-----------------------------------------------------------------------------------\n")
-            out.write(f"Cutoff (Prediction Threshold): {threshold}\n")
-            out.write(f"EPS: {eps}\n")
-            out.write(f"top n + {top_n_plus} prediction\n")
-            out.write("-----------------------------------------------------------------------------------\n")
-            out.write(f"Number of systems with no predictions: {np.sum(no_prediction_count)}\n")
+                io_futures.append(io_pool.submit(np.savez, f"{overlap_path}/{argstring}_n+{top_n_plus}.npz", 
+                 DCC_lig=np.array(DCC_lig, dtype=object), DCA=np.array(DCA, dtype=object), n_predicted=n_predicted, names=names))
+
+                n_predicted = np.array(n_predicted)
+                avg_n_predicted = np.nanmean(n_predicted)
+                no_prediction_total = np.sum(no_prediction_count)
+
+                print("-----------------------------------------------------------------------------------", flush=True)
+                print(f"Method: {method}")
+                print(f"Cutoff (Prediction Threshold): {threshold}")
+                print(f"EPS: {eps}")
+                print(f"top n + {top_n_plus} prediction")
+                print("-----------------------------------------------------------------------------------", flush=True)
+                print(f"Number of systems with no predictions: {no_prediction_total}", flush=True)
+
+                out.write(f"Method: {method}\n")
+                out.write("-----------------------------------------------------------------------------------\n")
+                out.write(f"Cutoff (Prediction Threshold): {threshold}\n")
+                out.write(f"EPS: {eps}\n")
+                out.write(f"top n + {top_n_plus} prediction\n")
+                out.write("-----------------------------------------------------------------------------------\n")
+                out.write(f"Number of systems with no predictions: {no_prediction_total}\n")
     
-            DCC_lig_recall, DCC_lig_precision = criteria_to_metrics(DCC_lig, top_predicted)
-            DCA_recall, DCA_precision = criteria_to_metrics(DCA, top_predicted)
+                DCC_lig_recall, DCC_lig_precision = criteria_to_metrics(DCC_lig, top_predicted)
+                DCA_recall, DCA_precision = criteria_to_metrics(DCA, top_predicted)
 
             
-            print(f"DCC_lig Recall: {DCC_lig_recall}", flush=True)
-            print(f"DCC_lig Precision: {DCC_lig_precision}", flush=True)
+                print(f"DCC_lig Recall: {DCC_lig_recall}", flush=True)
+                print(f"DCC_lig Precision: {DCC_lig_precision}", flush=True)
 
-            print(f"DCA Recall: {DCA_recall}", flush=True)
-            print(f"DCA Precision: {DCA_precision}", flush=True)
+                print(f"DCA Recall: {DCA_recall}", flush=True)
+                print(f"DCA Precision: {DCA_precision}", flush=True)
 
-            print(f"Average n_predicted: {np.nanmean(n_predicted)}", flush=True)
+                print(f"Average n_predicted: {avg_n_predicted}", flush=True)
 
             
-            out.write(f"DCC_lig Recall: {DCC_lig_recall}\n")
-            out.write(f"DCC_lig Precision: {DCC_lig_precision}\n")
-
-            out.write(f"DCA Recall: {DCA_recall}\n")
-            out.write(f"DCA Precision: {DCA_precision}\n")
-
-            out.write(f"Average n_predicted: {np.nanmean(n_predicted)}\n")
-            #######################################################################################
-
-        for top in top_list:
-            print(f"Calculating top {top} metrics for {threshold} threshold with distance cutoff {eps}.", flush=True)
-            out.write(f"Calculating top {top} metrics for {threshold} threshold with distance cutoff {eps}.\n")
-            start = time.time()
-            path_to_mol2= data_dir + '/mol2/'
-            path_to_labels= prepend + metric_dir + '/labels/' + model_name + '/'
-            DCC_lig, DCA, n_predicted, top_predicted, no_prediction_count, names = compute_metrics_for_all(
-            path_to_mol2, path_to_labels, top_n_plus=top, threshold=threshold, eps=eps, resolution=resolution,
-            method=method, score_type=score_type, centroid_type=centroid_type, use_surface=use_surface, use_connolly=use_connolly, 
-            ligand_merge=ligand_merge, known_n_sites=False)
-
-            print("Done. {}".format(time.time()- start))
-            out.write("Done. {}\n".format(time.time()- start))
+                out.write(f"DCC_lig Recall: {DCC_lig_recall}\n")
+                out.write(f"DCC_lig Precision: {DCC_lig_precision}\n")
+
+                out.write(f"DCA Recall: {DCA_recall}\n")
+                out.write(f"DCA Precision: {DCA_precision}\n")
+
+                out.write(f"Average n_predicted: {avg_n_predicted}\n")
+                #######################################################################################
+
+            for top in top_list:
+                print(f"Calculating top {top} metrics for {threshold} threshold with distance cutoff {eps}.", flush=True)
+                out.write(f"Calculating top {top} metrics for {threshold} threshold with distance cutoff {eps}.\n")
+                start = time.time()
+                DCC_lig, DCA, n_predicted, top_predicted, no_prediction_count, names = compute_metrics_for_all(
+                assemblies, top_n_plus=top, threshold=threshold, eps=eps, resolution=resolution,
+                method=method, score_type=score_type, centroid_type=centroid_type, known_n_sites=False)
+
+                print("Done. {}".format(time.time()- start))
+                out.write("Done. {}\n".format(time.time()- start))
             
-            overlap_path = f"{prepend}{metric_dir}/overlaps/{model_name}"
-            if not os.path.isdir(overlap_path):
-                os.makedirs(overlap_path)
+                overlap_path = f"{prepend}{metric_dir}/overlaps/{model_name}"
+                if not os.path.isdir(overlap_path):
+                    os.makedirs(overlap_path)
             
 
-            np.savez(f"{overlap_path}/{argstring}_top{top}.npz", DCC_lig=np.array(DCC_lig, dtype=object), DCA=np.array(DCA, dtype=object),
-             n_predicted=n_predicted, names=names)
-
-            n_predicted = np.array(n_predicted)
-
-            print("-----------------------------------------------------------------------------------", flush=True)
-            print(f"Method: {method}")
-            print(f"Cutoff (Prediction Threshold): {threshold}")
-            print(f"EPS: {eps}")
-            print(f"top {top} prediction")
-            print("-----------------------------------------------------------------------------------", flush=True)
-            print(f"Number of systems with no predictions: {np.sum(no_prediction_count)}", flush=True)
-
-            out.write(f"Method: {method}\n")
-            out.write("-----------------------------------------------------------------------------------\n")
-            out.write(f"Cutoff (Prediction Threshold): {threshold}\n")
-            out.write(f"EPS: {eps}\n")
-            out.write(f"top {top} prediction\n")
-            out.write("-----------------------------------------------------------------------------------\n")
-            out.write(f"Number of systems with no predictions: {np.sum(no_prediction_count)}\n")
+                io_futures.append(io_pool.submit(np.savez, f"{overlap_path}/{argstring}_top{top}.npz", 
+                 DCC_lig=np.array(DCC_lig, dtype=object), DCA=np.array(DCA, dtype=object), n_predicted=n_predicted, names=names))
+
+                n_predicted = np.array(n_predicted)
+                avg_n_predicted = np.nanmean(n_predicted)
+                no_prediction_total = np.sum(no_prediction_count)
+
+                print("-----------------------------------------------------------------------------------", flush=True)
+                print(f"Method: {method}")
+                print(f"Cutoff (Prediction Threshold): {threshold}")
+                print(f"EPS: {eps}")
+                print(f"top {top} prediction")
+                print("-----------------------------------------------------------------------------------", flush=True)
+                print(f"Number of systems with no predictions: {no_prediction_total}", flush=True)
+
+                out.write(f"Method: {method}\n")
+                out.write("-----------------------------------------------------------------------------------\n")
+                out.write(f"Cutoff (Prediction Threshold): {threshold}\n")
+                out.write(f"EPS: {eps}\n")
+                out.write(f"top {top} prediction\n")
+                out.write("-----------------------------------------------------------------------------------\n")
+                out.write(f"Number of systems with no predictions: {no_prediction_total}\n")
     
-            DCC_lig_recall, DCC_lig_precision = criteria_to_metrics(DCC_lig, top_predicted)
-            DCA_recall, DCA_precision = criteria_to_metrics(DCA, top_predicted)
+                DCC_lig_recall, DCC_lig_precision = criteria_to_metrics(DCC_lig, top_predicted)
+                DCA_recall, DCA_precision = criteria_to_metrics(DCA, top_predicted)
 
             
-            print(f"DCC_lig Recall: {DCC_lig_recall}", flush=True)
-            print(f"DCC_lig Precision: {DCC_lig_precision}", flush=True)
+                print(f"DCC_lig Recall: {DCC_lig_recall}", flush=True)
+                print(f"DCC_lig Precision: {DCC_lig_precision}", flush=True)
 
-            print(f"DCA Recall: {DCA_recall}", flush=True)
-            print(f"DCA Precision: {DCA_precision}", flush=True)
+                print(f"DCA Recall: {DCA_recall}", flush=True)
+                print(f"DCA Precision: {DCA_precision}", flush=True)
 
-            print(f"Average n_predicted: {np.nanmean(n_predicted)}", flush=True)
+                print(f"Average n_predicted: {avg_n_predicted}", flush=True)
 
             
-            out.write(f"DCC_lig Recall: {DCC_lig_recall}\n")
-            out.write(f"DCC_lig Precision: {DCC_lig_precision}\n")
-
-            out.write(f"DCA Recall: {DCA_recall}\n")
-            out.write(f"DCA Precision: {DCA_precision}\n")
-
-            out.write(f"Average n_predicted: {np.nanmean(n_predicted)}\n")
-            #######################################################################################
+                out.write(f"DCC_lig Recall: {DCC_lig_recall}\n")
+                out.write(f"DCC_lig Precision: {DCC_lig_precision}\n")
+
+                out.write(f"DCA Recall: {DCA_recall}\n")
+                out.write(f"DCA Precision: {DCA_precision}\n")
+
+                out.write(f"Average n_predicted: {avg_n_predicted}\n")
+                #######################################################################################
+        io_pool.shutdown(wait=True)
+        for future in io_futures:
+            future.result() # Reraise any exception from writing the overlap files
+    finally:
+        # Remove the cached systems even if the sweep fails part way
+        shutil.rmtree(cache_dir, ignore_errors=True)
     out.close()
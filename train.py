@@ -2,27 +2,33 @@ import os
 import numpy as np
 import sys
 import argparse
+import socket
 
 
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 import torch.nn.functional as F
 import torch.optim as optim
-from torch_geometric.nn import DataParallel
-from torch_geometric.loader import DataListLoader
-
-from sklearn.metrics import accuracy_score, roc_auc_score, average_precision_score
-from sklearn.metrics import matthews_corrcoef as mcc
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
+from torch_scatter import scatter_std
+from torch_geometric.loader import DataLoader
 
 from torch.utils.tensorboard import SummaryWriter
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from GASP_dataset import GASPData
-from utils import distance_sigmoid, initialize_model
+from utils import fused_batch_metrics, initialize_model
 
 job_start_time = time.time()
 prepend = str(os.getcwd())
 
-def k_fold(dataset:GASPData,train_path:str, val_path, i):
+# Batch attributes used by the model and loss. Only these are copied to the gpu.
+DEVICE_KEYS = ('x', 'edge_index', 'edge_attr', 'y', 'surf_mask', 'batch')
+
+def k_fold(dataset:GASPData, val_path:str, i:int):
     """Returns a boolean mask over the dataset that seperates it into training and validation portions
      by UniProt ID. Cross-validation (CV) splits were precomputed in    
     Stepniewska-Dziubinska, M.M., Zielenkiewicz, P. & Siedlecki, P. Improving detection of 
@@ -33,9 +39,9 @@ def k_fold(dataset:GASPData,train_path:str, val_path, i):
     ----------
     dataset : GASPData
         GASPData object represented a dataset.
-    prepend : str
-        Prepend path where CV splits are stored.
-    fold_number : int
+    val_path : str
+        Path to the list of validation UniProt IDs for this CV split.
+    i : int
         Which CV split to use
 
     Returns
@@ -44,85 +50,98 @@ def k_fold(dataset:GASPData,train_path:str, val_path, i):
         A tuple of (training_mask, validation_mask, fold_number) which can be used as boolean masks over the dataset.
     """    
     val_names    = np.loadtxt(val_path, dtype=str)
-    train_names   = np.loadtxt(train_path, dtype=str)
-    
-    train_indices, val_indices = [], []
-    # Iterate over the raw dataset file names and check if they're in the training or validation file.
-    for idx, name in enumerate(dataset.raw_file_names):
-        if name[:4] in val_names: 
-            val_indices.append(idx)
-        if name[:4] in train_names:
-            train_indices.append(idx)
-
-    train_mask = torch.ones(len(dataset), dtype=torch.bool)
-    val_mask = torch.ones(len(dataset), dtype=torch.bool)
     
-    # Remove all val_indices from the training set and vice-versa
-    train_mask[val_indices] = 0
-    val_mask[train_mask] = 0
+    # Check which raw dataset file names are in the validation file.
+    prefixes = np.array([name[:4] for name in dataset.raw_file_names])
+    val_mask = torch.from_numpy(np.isin(prefixes, val_names))
+
+    # Everything outside the validation set is used for training
+    train_mask = ~val_mask
 
     return (dataset[train_mask], dataset[val_mask], i)
 
-def main(node_noise_std : float, training_split='cv'):
-    """Train a GrASP model.
+def reduce_epoch_metrics(batch_sums:list, batch_counts:list, device:torch.device, distributed:bool):
+    """Averages per-batch metric sums over every batch seen by every rank.
 
     Parameters
     ----------
-    node_noise_std : float
-        The standard distribution of the noise added to nodes for the Noisy Nodes protocol. 
-        For more information see:
-        Godwin, J.; Schaarschmidt, M.; Gaunt, A. L.; Sanchez-
-        Gonzalez, A.; Rubanova, Y.; Veliˇckovi ́c, P.; Kirkpatrick, J.;
-        Battaglia, P. Simple GNN Regularisation for 3D Molecular Prop-
-        erty Prediction and Beyond. International Conference on Learn-
-        ing Representations. 2022.
-    training_split : str, optional
-        Which dataset to use. If 'cv' use the cross validation splits, by default 'cv'
+    batch_sums : list
+        Sums of per-batch metrics accumulated by this rank over an epoch.
+    batch_counts : list
+        Number of batches this rank contributed to each sum.
+    device : torch.device
+        Device of this rank, used for the all-reduce.
+    distributed : bool
+        Whether a process group is initialized. If False the local means are returned.
+
+    Returns
+    -------
+    list
+        Mean of each metric over all batches in the epoch. NaN for a metric with no batches.
     """
-    # Training Hyperparameters
-    num_epochs = args.num_epochs
-    batch_size = args.batch_size
-    learning_rate = args.learning_rate
-    class_loss_weight = args.class_loss_weight
-    label_smoothing = args.label_smoothing
-    head_loss_weight = args.head_loss_weight
-    label_midpoint, label_slope = args.sigmoid_params
-    
+    totals = torch.tensor(batch_sums + batch_counts, dtype=torch.float64, device=device)
+    if distributed:
+        dist.all_reduce(totals)
+
+    sums, counts = totals.view(2, -1)
+    return (sums / counts).tolist()
+
+def find_free_port():
+    """Asks the OS for a currently unused TCP port on this node.
+
+    Returns
+    -------
+    int
+        A free port number.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('', 0))
+        return s.getsockname()[1]
+
+def load_splits(args:argparse.Namespace):
+    """Initializes the training and validation datasets for the requested training split.
+
+    Datasets are built once in the launching process so that preprocessing is not repeated
+    (or raced) by every training rank.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        Parsed command-line arguments, see the argument help strings.
+
+    Returns
+    -------
+    Tuple of (list, bool)
+        A tuple of (splits, do_validation) where splits is a list of (train_set, val_set, cv_iteration).
+    """
+    training_split = args.training_split
+    label_params = tuple(args.sigmoid_params)
+
     # Dataset Parameters
     k_hops = args.k_hops
     sasa_threshold = args.sasa_threshold
     fold_number = args.fold
-    
-    # Device Parameters
     num_cpus = args.n_tasks
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    
-    loss_fn = torch.nn.CrossEntropyLoss(label_smoothing=label_smoothing, weight=torch.FloatTensor(class_loss_weight).to(device))
-    
-    head_loss_weight = torch.tensor(head_loss_weight).to(device)
 
     # Initialize Training Split for Each Dataset
     if training_split == 'chen':
         do_validation = True
-        train_set = GASPData(f'{prepend}/benchmark_data_dir/chen11', num_cpus, cutoff=5, surface_subgraph_hops=k_hops, sasa_threshold=sasa_threshold)
-        val_set = GASPData(f'{prepend}/benchmark_data_dir/joined', num_cpus, cutoff=5, surface_subgraph_hops=k_hops, sasa_threshold=sasa_threshold)
+        train_set = GASPData(f'{prepend}/benchmark_data_dir/chen11', num_cpus, cutoff=5, surface_subgraph_hops=k_hops, sasa_threshold=sasa_threshold, label_params=label_params, packed=args.packed_dataset)
+        val_set = GASPData(f'{prepend}/benchmark_data_dir/joined', num_cpus, cutoff=5, surface_subgraph_hops=k_hops, sasa_threshold=sasa_threshold, label_params=label_params, packed=args.packed_dataset)
 
         gen = zip([train_set], [val_set], [0])
     
     else:
-        data_set = GASPData(prepend + '/scPDB_data_dir', num_cpus, cutoff=5, surface_subgraph_hops=k_hops, sasa_threshold=sasa_threshold)
+        data_set = GASPData(prepend + '/scPDB_data_dir', num_cpus, cutoff=5, surface_subgraph_hops=k_hops, sasa_threshold=sasa_threshold, label_params=label_params, packed=args.packed_dataset)
         
         do_validation = False
         if training_split == 'cv':
             do_validation = True
             val_paths = []
-            train_paths = []
             
             val_paths.append(prepend + "/splits/test_ids_fold"  + str(fold_number))
-            train_paths.append(prepend + "/splits/train_ids_fold" + str(fold_number))
-            data_points = zip(train_paths,val_paths)
 
-            gen = (k_fold(data_set, train_path, val_path, fold_number) for (train_path, val_path) in data_points)
+            gen = (k_fold(data_set, val_path, fold_number) for val_path in val_paths)
 
         elif training_split == 'train_full':
             do_validation = False
@@ -139,25 +158,102 @@ def main(node_noise_std : float, training_split='cv'):
                 train_names = np.loadtxt(prepend + f'{train_prefix}holo4k_uniprot', dtype=str)
             elif training_split == 'holo4k_mlig':
                 train_names = np.loadtxt(prepend + f'{train_prefix}holo4k(mlig)_uniprot', dtype=str)
-            train_indices = []
-            # Iterate over training names and add to the train set if included in the split
-            for idx, name in enumerate(data_set.raw_file_names):
-                if name.split('_')[0] in train_names:
-                    train_indices.append(idx)
-            train_mask = torch.zeros(len(data_set), dtype=torch.bool)
-            train_mask[train_indices] = 1
+            # Add raw files to the train set if included in the split
+            prefixes = np.array([name.split('_')[0] for name in data_set.raw_file_names])
+            train_mask = torch.from_numpy(np.isin(prefixes, train_names))
             gen = zip([data_set[train_mask]],[data_set[torch.zeros(len(data_set),dtype=torch.bool)]],[0])
 
-    for train_set, val_set, cv_iteration in gen:
-        model = initialize_model(args)
-        model =  DataParallel(model)
-        model.to(device)
+    return list(gen), do_validation
+
+def main(rank:int, world_size:int, args:argparse.Namespace, model_id:str, splits:list, do_validation:bool):
+    """Train a GrASP model on one device. With more than one GPU, one process is spawned per GPU
+    and the model is wrapped in DistributedDataParallel.
+
+    Parameters
+    ----------
+    rank : int
+        Rank of this process, also used as its CUDA device index.
+    world_size : int
+        Total number of training processes.
+    args : argparse.Namespace
+        Parsed command-line arguments, see the argument help strings. args.node_noise_std is the 
+        standard distribution of the noise added to nodes for the Noisy Nodes protocol. 
+        For more information see:
+        Godwin, J.; Schaarschmidt, M.; Gaunt, A. L.; Sanchez-
+        Gonzalez, A.; Rubanova, Y.; Veliˇckovi ́c, P.; Kirkpatrick, J.;
+        Battaglia, P. Simple GNN Regularisation for 3D Molecular Prop-
+        erty Prediction and Beyond. International Conference on Learn-
+        ing Representations. 2022.
+    model_id : str
+        Name used for the log directory and saved checkpoints.
+    splits : list
+        List of (train_set, val_set, cv_iteration) as returned by load_splits.
+    do_validation : bool
+        Whether to evaluate val_set after every epoch.
+    """
+    # Training Hyperparameters
+    node_noise_std = args.node_noise_std
+    training_split = args.training_split
+    surface_only = not args.all_atom_prediction
+    num_epochs = args.num_epochs
+    learning_rate = args.learning_rate
+    class_loss_weight = args.class_loss_weight
+    label_smoothing = args.label_smoothing
+    head_loss_weight = args.head_loss_weight
+
+    # The global batch is split across ranks, as DataParallel did
+    batch_size = max(1, args.batch_size // world_size)
+    
+    # Device Parameters
+    num_cpus = args.n_tasks // world_size
+    distributed = world_size > 1
+    is_main = rank == 0
+    if distributed:
+        dist.init_process_group('nccl', rank=rank, world_size=world_size)
+        torch.cuda.set_device(rank)
+    device = torch.device(f'cuda:{rank}' if torch.cuda.is_available() else 'cpu')
+
+    # Optionally allow TF32 tensor cores for fp32 matmuls in the linear and attention layers
+    if args.tf32:
+        torch.set_float32_matmul_precision('high')
+
+    # Mixed precision: parameters stay in fp32, forward and loss run in amp_dtype under autocast
+    amp_dtype = {'bf16': torch.bfloat16, 'fp16': torch.float16}.get(args.mixed_precision)
+    use_amp = amp_dtype is not None and device.type == 'cuda'
+    
+    loss_fn = torch.nn.CrossEntropyLoss(label_smoothing=label_smoothing, weight=torch.FloatTensor(class_loss_weight).to(device))
+    
+    head_loss_weight = torch.tensor(head_loss_weight).to(device)
+
+    # Keep loader workers alive across epochs and prefetch deeper to hide graph loading behind compute
+    loader_kwargs = dict(pin_memory=True, num_workers=num_cpus)
+    if num_cpus > 0:
+        loader_kwargs.update(persistent_workers=True, prefetch_factor=4)
+
+    # Checkpoints are written on a background thread so the next epoch can start
+    ckpt_pool = ThreadPoolExecutor(max_workers=1)
+    ckpt_futures = []
+
+    for train_set, val_set, cv_iteration in splits:
+        base_model = initialize_model(args).to(device)
+        model = base_model
+        if args.compile:
+            # dynamic=True avoids recompiling for every new node count
+            model = torch.compile(model, dynamic=True)
+        if distributed:
+            model = DistributedDataParallel(model, device_ids=[rank])
         
         optimizer = optim.Adam(model.parameters(), lr = learning_rate)
-        scheduler = optim.lr_scheduler.ExponentialLR(optimizer, gamma=0.95, verbose=True)
+        scaler = torch.cuda.amp.GradScaler(enabled=use_amp and amp_dtype == torch.float16)
+        scheduler = optim.lr_scheduler.ExponentialLR(optimizer, gamma=0.95, verbose=is_main)
         
-        train_dataloader = DataListLoader(train_set, batch_size=batch_size, shuffle=True, pin_memory=True, num_workers=num_cpus)
-        if do_validation: val_dataloader = DataListLoader(val_set, batch_size=batch_size, shuffle=True, pin_memory=True, num_workers=num_cpus)
+        # Each rank iterates over its own shard of the data
+        train_sampler = DistributedSampler(train_set, num_replicas=world_size, rank=rank, shuffle=True) if distributed else None
+        train_dataloader = DataLoader(train_set, batch_size=batch_size, shuffle=train_sampler is None, sampler=train_sampler, **loader_kwargs)
+        if do_validation: 
+            # Strided shards without padding, so no validation graph is counted twice in the reduced metrics
+            val_sampler = range(rank, len(val_set), world_size) if distributed else None
+            val_dataloader = DataLoader(val_set, batch_size=batch_size, shuffle=False, sampler=val_sampler, **loader_kwargs)
         # Track Training Statistics
         training_epoch_loss = []
         training_epoch_acc = []
@@ -171,14 +267,19 @@ def main(node_noise_std : float, training_split='cv'):
         val_epoch_auc = []
         val_epoch_pr_auc = []
 
-        writer = SummaryWriter(log_dir='atom_wise_model_logs/' + training_split + '/cv_split_' + str(cv_iteration) + "/" + model_id)
+        # Only rank 0 logs and saves checkpoints
+        if is_main: writer = SummaryWriter(log_dir='atom_wise_model_logs/' + training_split + '/cv_split_' + str(cv_iteration) + "/" + model_id)
         train_batch_num, val_batch_num = 0,0
         train_epoch_num, val_epoch_num = 0,0
+
+        # Reused for the Noisy Nodes samples, grown when a batch has more nodes than any before it
+        noise_buffer = torch.empty(0, device=device)
         
         for epoch in range(num_epochs):
             # Training Set
             model.train()
-            if (train_epoch_num==0):
+            if distributed: train_sampler.set_epoch(epoch)
+            if (train_epoch_num==0 and is_main):
                 print("Running {} batches per Epoch".format(len(train_dataloader)), flush=True)
                 epoch_start = time.time()
             training_batch_loss = 0.0
@@ -186,165 +287,181 @@ def main(node_noise_std : float, training_split='cv'):
             training_batch_mcc = 0.0
             training_batch_auc = 0.0
             training_batch_pr_auc = 0.0
-            for batch in train_dataloader:
-                # Strip batches of raw file names
-                batch = list(map(lambda x: x[0].to(device), batch))
-                
-                unperturbed_x = torch.cat([data.x for data in batch]).clone().detach().to(device)
-                for data in batch:
-                    data.x += (data.x.std(dim=0) * node_noise_std) * torch.randn_like(data.x)   # Add noise for Noisy Nodes Regularization
-                    data.y = distance_sigmoid(data.y, label_midpoint, label_slope)              # Compute soft labels with sigmoid of distnace
-                    data.y = torch.stack([1-data.y, data.y], dim=1)
+            training_ranked_batches = 0 # Batches with both classes, where AUC and PR AUC are defined
+            for batch, _ in train_dataloader:
+                batch = batch.to(device, *DEVICE_KEYS, non_blocking=True)
+                unperturbed_x = batch.x
+
+                # Add noise for Noisy Nodes Regularization, scaled by the per-graph feature std
+                if noise_buffer.size(0) < unperturbed_x.size(0):
+                    noise_buffer = torch.empty_like(unperturbed_x)
+                noise = noise_buffer[:unperturbed_x.size(0)].normal_()
+                x_std = scatter_std(unperturbed_x, batch.batch, dim=0)[batch.batch]
+                batch.x = torch.addcmul(unperturbed_x, x_std, noise, value=node_noise_std)
                     
-                labels  = torch.cat([data.y for data in batch]).clone().detach().cpu().numpy()  # Labels for metrics
-                y       = torch.cat([data.y for data in batch]).to(device)                      # Labels for training
-                surf_mask = torch.cat([data.surf_mask for data in batch]).to(device)
+                y       = batch.y.float()                                                       # Soft labels for training
+                surf_mask = batch.surf_mask
             
                 optimizer.zero_grad(set_to_none=True)
-                out, out_recon = model.forward(batch)
+                with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=use_amp):
+                    out, out_recon = model(batch)
 
-                if surface_only:
-                    labels = labels[surf_mask.detach().cpu().numpy()]
-                    y = y[surf_mask]
-                    unperturbed_x = unperturbed_x[surf_mask]
+                    if surface_only:
+                        y = y[surf_mask]
+                        unperturbed_x = unperturbed_x[surf_mask]
 
-                    out = out[surf_mask]
-                    out_recon = out_recon[surf_mask]
+                        out = out[surf_mask]
+                        out_recon = out_recon[surf_mask]
 
-                weighted_xent_l = head_loss_weight[0] * loss_fn(out,y),  
-                mse_l           = head_loss_weight[1] * F.mse_loss(out_recon, unperturbed_x)          
-                
-                loss = weighted_xent_l + mse_l
-                loss.backward() 
-                optimizer.step()
+                    weighted_xent_l = head_loss_weight[0] * loss_fn(out,y),  
+                    mse_l           = head_loss_weight[1] * F.mse_loss(out_recon, unperturbed_x)          
+                    
+                    loss = weighted_xent_l + mse_l
+                scaler.scale(loss).backward() 
+                scaler.step(optimizer)
+                scaler.update()
 
-                probs = out.softmax(dim=-1).detach().cpu().numpy()
-                preds = np.argmax(probs, axis=1)
-                hard_labels = np.argmax(labels, axis=1)
+                hard_labels = (y[:,1] > .5).long()
 
                 l = loss.detach().cpu().item()
                 
                 # Compute and save batch training statistics
                 bl = l 
-                ba = accuracy_score(hard_labels, preds)
-                bm = mcc(hard_labels, preds)
-                bc = roc_auc_score(hard_labels, probs[:,1])
-                bpr = average_precision_score(hard_labels, probs[:,1])
+                ba, bm, bc, bpr = fused_batch_metrics(out.detach().float(), hard_labels)
                 training_batch_loss += bl
                 training_batch_acc  += ba
                 training_batch_mcc  += bm
-                training_batch_auc  += bc
-                training_batch_pr_auc += bpr
-
-                writer.add_scalar('Batch_Loss/Train', bl, train_batch_num)
-                writer.add_scalar('Batch_ACC/Train',  ba,  train_batch_num)
-                writer.add_scalar('Batch_MCC/Train',  bm,  train_batch_num)
-                writer.add_scalar('Batch_AUC/Train',  bc,  train_batch_num)
-                writer.add_scalar('Batch_PR_AUC/Train', bpr, train_batch_num)
+                if not np.isnan(bc):
+                    training_batch_auc  += bc
+                    training_batch_pr_auc += bpr
+                    training_ranked_batches += 1
+
+                if is_main:
+                    writer.add_scalar('Batch_Loss/Train', bl, train_batch_num)
+                    writer.add_scalar('Batch_ACC/Train',  ba,  train_batch_num)
+                    writer.add_scalar('Batch_MCC/Train',  bm,  train_batch_num)
+                    writer.add_scalar('Batch_AUC/Train',  bc,  train_batch_num)
+                    writer.add_scalar('Batch_PR_AUC/Train', bpr, train_batch_num)
                 train_batch_num += 1
                 
             scheduler.step()
-            print("******* EPOCH END, EPOCH TIME: {}".format(time.time() - epoch_start))
             
             # Compute and save epoch training statistics
-            training_epoch_loss.append(training_batch_loss/len(train_dataloader))
-            training_epoch_acc.append(training_batch_acc/len(train_dataloader))
-            training_epoch_mcc.append(training_batch_mcc/len(train_dataloader))
-            training_epoch_auc.append(training_batch_auc/len(train_dataloader))
-            training_epoch_pr_auc.append(training_batch_pr_auc/len(train_dataloader))
-            print("Training Epoch {} Loss: {}".format(epoch, training_epoch_loss[-1]))
-            print("Training Epoch {} Accu: {}".format(epoch, training_epoch_acc[-1]))
-            print("Training Epoch {} MCC: {}".format(epoch, training_epoch_mcc[-1]))
-            print("Training Epoch {} AUC: {}".format(epoch, training_epoch_auc[-1]), flush=True)
-            print("Training Epoch {} PR AUC: {}".format(epoch, training_epoch_pr_auc[-1]), flush=True)
-            writer.add_scalar('Epoch_Loss/Train', training_epoch_loss[-1], train_epoch_num)
-            writer.add_scalar('Epoch_ACC/Train',  training_epoch_acc[-1],  train_epoch_num)
-            writer.add_scalar('Epoch_MCC/Train',  training_epoch_mcc[-1],  train_epoch_num)
-            writer.add_scalar('Epoch_AUC/Train',  training_epoch_auc[-1],  train_epoch_num)
-            writer.add_scalar('Epoch_PR_AUC/Train', training_epoch_pr_auc[-1], train_epoch_num)
-
-            # Save model checkpoint
-            if not os.path.isdir("./trained_models/{}/trained_model_{}/cv_{}/".format(training_split, model_id, cv_iteration)):
-                os.makedirs("./trained_models/{}/trained_model_{}/cv_{}/".format(training_split, model_id, cv_iteration))
-            torch.save(model.module.state_dict(), "./trained_models/{}/trained_model_{}/cv_{}/epoch_{}".format(training_split, model_id, cv_iteration, train_epoch_num))
+            epoch_loss, epoch_acc, epoch_mcc, epoch_auc, epoch_pr_auc = reduce_epoch_metrics(
+                [training_batch_loss, training_batch_acc, training_batch_mcc, training_batch_auc, training_batch_pr_auc],
+                [len(train_dataloader)]*3 + [training_ranked_batches]*2, device, distributed)
+            training_epoch_loss.append(epoch_loss)
+            training_epoch_acc.append(epoch_acc)
+            training_epoch_mcc.append(epoch_mcc)
+            training_epoch_auc.append(epoch_auc)
+            training_epoch_pr_auc.append(epoch_pr_auc)
+            if is_main:
+                print("******* EPOCH END, EPOCH TIME: {}".format(time.time() - epoch_start))
+                if training_ranked_batches < len(train_dataloader):
+                    print("Warning: {} training batches on rank 0 had a single class and were left out of AUC and PR AUC".format(len(train_dataloader) - training_ranked_batches))
+                print("Training Epoch {} Loss: {}".format(epoch, training_epoch_loss[-1]))
+                print("Training Epoch {} Accu: {}".format(epoch, training_epoch_acc[-1]))
+                print("Training Epoch {} MCC: {}".format(epoch, training_epoch_mcc[-1]))
+                print("Training Epoch {} AUC: {}".format(epoch, training_epoch_auc[-1]), flush=True)
+                print("Training Epoch {} PR AUC: {}".format(epoch, training_epoch_pr_auc[-1]), flush=True)
+                writer.add_scalar('Epoch_Loss/Train', training_epoch_loss[-1], train_epoch_num)
+                writer.add_scalar('Epoch_ACC/Train',  training_epoch_acc[-1],  train_epoch_num)
+                writer.add_scalar('Epoch_MCC/Train',  training_epoch_mcc[-1],  train_epoch_num)
+                writer.add_scalar('Epoch_AUC/Train',  training_epoch_auc[-1],  train_epoch_num)
+                writer.add_scalar('Epoch_PR_AUC/Train', training_epoch_pr_auc[-1], train_epoch_num)
+
+                # Save model checkpoint every ckpt_every epochs and after the final epoch
+                if (train_epoch_num + 1) % args.ckpt_every == 0 or train_epoch_num == num_epochs - 1:
+                    if not os.path.isdir("./trained_models/{}/trained_model_{}/cv_{}/".format(training_split, model_id, cv_iteration)):
+                        os.makedirs("./trained_models/{}/trained_model_{}/cv_{}/".format(training_split, model_id, cv_iteration))
+                    # Snapshot the weights on the cpu so the next optimizer steps cannot change them mid-write
+                    state_dict = {key: value.detach().to('cpu', copy=True) for key, value in base_model.state_dict().items()}
+                    ckpt_futures.append(ckpt_pool.submit(torch.save, state_dict, "./trained_models/{}/trained_model_{}/cv_{}/epoch_{}".format(training_split, model_id, cv_iteration, train_epoch_num)))
             
             train_epoch_num += 1
 
             if do_validation:
                 model.eval()
+                # Ranks may see different numbers of validation batches, so bypass DDP and its collectives
+                eval_model = model.module if distributed else model
                 with torch.no_grad():
                     val_batch_loss = 0.0
                     val_batch_acc = 0.0
                     val_batch_mcc = 0.0
                     val_batch_auc = 0.0
                     val_batch_pr_auc = 0.0
+                    val_ranked_batches = 0
 
-                    for batch in val_dataloader:
-                        # Strip batches of raw file names
-                        batch = list(map(lambda x: x[0].to(device), batch))
+                    for batch, _ in val_dataloader:
+                        batch = batch.to(device, *DEVICE_KEYS, non_blocking=True)
                 
                         # Note: we do not apply the Noisy Nodes protocol to validation samples
                         
-                        for data in batch:
-                            data.y = distance_sigmoid(data.y, label_midpoint, label_slope)              # Compute soft labels with sigmoid of distnace
-                            data.y = torch.stack([1-data.y, data.y], dim=1)
-                        labels  = torch.cat([data.y for data in batch]).clone().detach().cpu().numpy()  # Labels for metrics
-                        y       = torch.cat([data.y for data in batch]).to(device)                      # Labels for loss computation
-                        surf_mask = torch.cat([data.surf_mask for data in batch]).to(device)            
+                        y       = batch.y.float()                                                       # Soft labels for loss computation
+                        surf_mask = batch.surf_mask
                     
-                        optimizer.zero_grad(set_to_none=True)
-
-                        out, _ = model.forward(batch)
+                        with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=use_amp):
+                            out, _ = eval_model(batch)
 
-                        if surface_only:
-                            labels = labels[surf_mask.detach().cpu().numpy()]
-                            y = y[surf_mask]
-                            out = out[surf_mask]
+                            if surface_only:
+                                y = y[surf_mask]
+                                out = out[surf_mask]
 
-                        loss = loss_fn(out,y)
-                        probs = out.softmax(dim=-1).detach().cpu().numpy()
-                        preds = np.argmax(probs, axis=1)
-                        hard_labels = np.argmax(labels, axis=1) # converting to binary labels for metrics
+                            loss = loss_fn(out,y)
+                        hard_labels = (y[:,1] > .5).long() # converting to binary labels for metrics
                         
                         # Compute and save batch training statistics
                         bl = loss.detach().cpu().item()
-                        ba = accuracy_score(hard_labels, preds)
-                        bm = mcc(hard_labels, preds)
-                        bc = roc_auc_score(hard_labels, probs[:,1])
-                        bpr = average_precision_score(hard_labels, probs[:,1])
+                        ba, bm, bc, bpr = fused_batch_metrics(out.float(), hard_labels)
                         val_batch_loss += bl
                         val_batch_acc  += ba
                         val_batch_mcc  += bm
-                        val_batch_auc  += bc
-                        val_batch_pr_auc += bpr
-
-                        writer.add_scalar('Batch_Loss/Val', bl, val_batch_num)
-                        writer.add_scalar('Batch_ACC/Val',  ba,  val_batch_num)
-                        writer.add_scalar('Batch_MCC/Val',  bm,  val_batch_num)
-                        writer.add_scalar('Batch_AUC/Val',  bc,  val_batch_num)
-                        writer.add_scalar('Batch_PR_AUC/Val', bpr, val_batch_num)
+                        if not np.isnan(bc):
+                            val_batch_auc  += bc
+                            val_batch_pr_auc += bpr
+                            val_ranked_batches += 1
+
+                        if is_main:
+                            writer.add_scalar('Batch_Loss/Val', bl, val_batch_num)
+                            writer.add_scalar('Batch_ACC/Val',  ba,  val_batch_num)
+                            writer.add_scalar('Batch_MCC/Val',  bm,  val_batch_num)
+                            writer.add_scalar('Batch_AUC/Val',  bc,  val_batch_num)
+                            writer.add_scalar('Batch_PR_AUC/Val', bpr, val_batch_num)
                         val_batch_num += 1
 
                     # Compute and save epoch training statistics
-                    val_epoch_loss.append(val_batch_loss/len(val_dataloader))
-                    val_epoch_acc.append(val_batch_acc/len(val_dataloader))
-                    val_epoch_mcc.append(val_batch_mcc/len(val_dataloader))
-                    val_epoch_auc.append(val_batch_auc/len(val_dataloader))
-                    val_epoch_pr_auc.append(val_batch_pr_auc/len(val_dataloader))
-                    print("Validation Epoch {} Loss: {}".format(epoch, val_epoch_loss[-1]))
-                    print("Validation Epoch {} Accu: {}".format(epoch, val_epoch_acc[-1]))
-                    print("Validation Epoch {} MCC: {}".format(epoch, val_epoch_mcc[-1]))
-                    print("Validation Epoch {} AUC: {}".format(epoch, val_epoch_auc[-1]))
-                    print("Validation Epoch {} PR AUC: {}".format(epoch, val_epoch_pr_auc[-1]))
-                    writer.add_scalar('Epoch_Loss/Val', val_epoch_loss[-1], val_epoch_num)
-                    writer.add_scalar('Epoch_ACC/Val',  val_epoch_acc[-1],  val_epoch_num)
-                    writer.add_scalar('Epoch_MCC/Val',  val_epoch_mcc[-1],  val_epoch_num)
-                    writer.add_scalar('Epoch_AUC/Val',  val_epoch_auc[-1],  val_epoch_num)
-                    writer.add_scalar('Epoch_PR_AUC/Val',  val_epoch_pr_auc[-1],  val_epoch_num)
+                    epoch_loss, epoch_acc, epoch_mcc, epoch_auc, epoch_pr_auc = reduce_epoch_metrics(
+                        [val_batch_loss, val_batch_acc, val_batch_mcc, val_batch_auc, val_batch_pr_auc],
+                        [len(val_dataloader)]*3 + [val_ranked_batches]*2, device, distributed)
+                    val_epoch_loss.append(epoch_loss)
+                    val_epoch_acc.append(epoch_acc)
+                    val_epoch_mcc.append(epoch_mcc)
+                    val_epoch_auc.append(epoch_auc)
+                    val_epoch_pr_auc.append(epoch_pr_auc)
+                    if is_main:
+                        if val_ranked_batches < len(val_dataloader):
+                            print("Warning: {} validation batches on rank 0 had a single class and were left out of AUC and PR AUC".format(len(val_dataloader) - val_ranked_batches))
+                        print("Validation Epoch {} Loss: {}".format(epoch, val_epoch_loss[-1]))
+                        print("Validation Epoch {} Accu: {}".format(epoch, val_epoch_acc[-1]))
+                        print("Validation Epoch {} MCC: {}".format(epoch, val_epoch_mcc[-1]))
+                        print("Validation Epoch {} AUC: {}".format(epoch, val_epoch_auc[-1]))
+                        print("Validation Epoch {} PR AUC: {}".format(epoch, val_epoch_pr_auc[-1]))
+                        writer.add_scalar('Epoch_Loss/Val', val_epoch_loss[-1], val_epoch_num)
+                        writer.add_scalar('Epoch_ACC/Val',  val_epoch_acc[-1],  val_epoch_num)
+                        writer.add_scalar('Epoch_MCC/Val',  val_epoch_mcc[-1],  val_epoch_num)
+                        writer.add_scalar('Epoch_AUC/Val',  val_epoch_auc[-1],  val_epoch_num)
+                        writer.add_scalar('Epoch_PR_AUC/Val',  val_epoch_pr_auc[-1],  val_epoch_num)
 
                     val_epoch_num += 1
 
-        writer.close()
+        if is_main: writer.close()
+
+    ckpt_pool.shutdown(wait=True)
+    for future in ckpt_futures:
+        future.result() # Reraise any exception from saving checkpoints
+
+    if distributed:
+        dist.destroy_process_group()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Train a GNN for binding site prediction.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -365,15 +482,30 @@ if __name__ == "__main__":
     parser.add_argument("-ao", "--all_atom_prediction", action="store_true", help="Option to perform inference on all atoms as opposed to solvent exposed.")
     parser.add_argument("-kh", "--k_hops", type=int, default=1, help="Number of hops for constructing a surface graph.")
     parser.add_argument("-st", "--sasa_threshold", type=float, default=1e-4, help="SASA above which atoms are considered on the surface.")
+    parser.add_argument("-pd", "--packed_dataset", action="store_true", help="Read graphs from a packed, memory-mapped copy of the processed dataset (built on first use).")
+    parser.add_argument("-mp", "--mixed_precision", default="fp32", choices=["fp32", "bf16", "fp16"], help="Autocast precision for the forward pass and loss. fp16 uses gradient scaling.")
+    parser.add_argument("-tf", "--tf32", action="store_true", help="Allow TF32 tensor cores for fp32 matmuls (Ampere or newer). Trades matmul precision for speed.")
+    parser.add_argument("-ce", "--ckpt_every", type=int, default=1, help="Save a model checkpoint every this many epochs. The final epoch is always saved.")
+    parser.add_argument("-tc", "--compile", action="store_true", help="Compile the model with torch.compile (requires PyTorch 2.0 or later).")
     parser.add_argument("-n", "--n_tasks", type=int, default=8, help="Number of cpu workers.")
     args = parser.parse_args()
+    if args.compile and not hasattr(torch, 'compile'):
+        parser.error("--compile requires PyTorch 2.0 or later, found {}".format(torch.__version__))
+    if args.ckpt_every < 1:
+        parser.error("--ckpt_every must be at least 1, got {}".format(args.ckpt_every))
     argstring='_'.join(sys.argv[1:]).replace('-','')
     model_id = f'{argstring}_{str(job_start_time)}'
 
-    node_noise_std = args.node_noise_std
-    training_split = args.training_split
-    surface_only = not args.all_atom_prediction
+    print("Training with noise with std", args.node_noise_std, "and mean 0 added to nodes.")
 
-    print("Training with noise with std", node_noise_std, "and mean 0 added to nodes.")
-    
-    main(node_noise_std, training_split)
+    splits, do_validation = load_splits(args)
+
+    # One training process per GPU
+    world_size = max(1, torch.cuda.device_count())
+    if world_size > 1:
+        # Rendezvous for the process group. A free port lets several jobs share a node
+        os.environ.setdefault('MASTER_ADDR', 'localhost')
+        os.environ.setdefault('MASTER_PORT', str(find_free_port()))
+        mp.spawn(main, args=(world_size, args, model_id, splits, do_validation), nprocs=world_size)
+    else:
+        main(0, 1, args, model_id, splits, do_validation)
@@ -81,3 +81,80 @@ def initialize_model(parser_args):
     else:
         raise ValueError("Unknown Model Type:", model_name)
     return model
+
+def binary_mcc(y_hard, preds):
+    """Compute the Matthews correlation coefficient of binary predictions in closed form.
+
+    The 2x2 confusion counts are taken from a single bincount of 2*y_hard + preds.
+
+    Parameters
+    ----------
+    y_hard : torch.Tensor
+        A tensor of shape [N] containing binary (0/1) labels.
+    preds : torch.Tensor
+        A tensor of shape [N] containing binary (0/1) predictions.
+
+    Returns
+    -------
+    torch.Tensor
+        A 0-d float64 tensor containing the MCC, or 0 if any confusion matrix margin is empty (as in sklearn).
+    """
+    # Confusion counts in the order [tn, fp, fn, tp]
+    tn, fp, fn, tp = torch.bincount(2*y_hard.long() + preds.long(), minlength=4).double()
+    mcc_denom = torch.sqrt((tp+fp) * (tp+fn) * (tn+fp) * (tn+fn))
+
+    return torch.where(mcc_denom > 0, (tp*tn - fp*fn) / mcc_denom, torch.zeros_like(mcc_denom))
+
+def fused_batch_metrics(out_logits, y_hard):
+    """Compute accuracy, MCC, ROC AUC, and average precision for a batch in one pass on-device.
+
+    Accuracy and MCC (see binary_mcc) are taken from the argmax predictions.
+    ROC AUC and average precision share a single descending sort of the positive class scores,
+    with tied scores collapsed into one threshold as in sklearn's roc_auc_score and average_precision_score.
+
+    Parameters
+    ----------
+    out_logits : torch.Tensor
+        A tensor of shape [N, 2] containing the model's output logits.
+    y_hard : torch.Tensor
+        A tensor of shape [N] containing binary (0/1) labels.
+
+    Returns
+    -------
+    tuple of float
+        A tuple of (accuracy, mcc, roc_auc, average_precision). Ranking metrics are undefined when the batch
+        contains only one class (sklearn's roc_auc_score raises), so AUC and AP are both returned as NaN
+        in that case and should be left out of any running mean.
+    """
+    y_hard = y_hard.long()
+    preds = out_logits.argmax(dim=-1)
+    acc = (preds == y_hard).double().mean()
+    mcc = binary_mcc(y_hard, preds)
+
+    scores = out_logits.softmax(dim=-1)[:,1]
+    order = torch.argsort(scores, descending=True)
+    sorted_scores = scores[order]
+    sorted_labels = y_hard[order].double()
+
+    # Cumulative counts at the last position of each run of tied scores
+    tps = torch.cumsum(sorted_labels, dim=0)
+    fps = torch.cumsum(1 - sorted_labels, dim=0)
+    threshold_mask = torch.ones_like(sorted_scores, dtype=torch.bool)
+    threshold_mask[:-1] = sorted_scores[1:] != sorted_scores[:-1]
+    tps = tps[threshold_mask]
+    fps = fps[threshold_mask]
+
+    zero = tps.new_zeros(1)
+    tpr = torch.cat([zero, tps / tps[-1]])
+    fpr = torch.cat([zero, fps / fps[-1]])
+    roc_auc = torch.trapezoid(tpr, fpr)
+
+    precision = tps / (tps + fps)
+    average_precision = torch.sum(torch.diff(tpr) * precision)
+
+    both_classes = (tps[-1] > 0) & (fps[-1] > 0)
+    nan = torch.full_like(roc_auc, float('nan'))
+    roc_auc = torch.where(both_classes, roc_auc, nan)
+    average_precision = torch.where(both_classes, average_precision, nan)
+
+    return tuple(torch.stack([acc, mcc, roc_auc, average_precision]).tolist())